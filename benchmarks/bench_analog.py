@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the pyanalog kernels and the end-to-end Analog pipeline on seeded synthetic archives.
+
+Every case is timed (best of --repeat runs), its peak traced memory measured in a separate run, and (unless
+--no-check) its output compared against the slow per-grid-point versions in reference.py. Blocked, candidate-date,
+station and on-disk reader runs are checked against the in-memory find_analogs on tie-heavy data, index for index.
+Results are written as JSON so runs can be compared across versions:
+
+    python benchmarks/bench_analog.py --n-dates 500 2000 --grid 40x50 --grid-window 1 3 --output bench.json
+    python benchmarks/bench_analog.py --quick
+
+Throughput is forecast-domain grid points x training dates per second.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import itertools
+import tracemalloc
+import numpy as np
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import reference
+from pyanalog import Analog,open_archive
+from pyanalog.comp_funcs import _rank_analog_grid,_rmse_analog_grid,_mae_analog_grid,_corr_analog_grid,\
+    interp_proba,select_analogs,gen_proba_topk,rank_columns,compact_ranks,update_rank_climatology
+
+kernels = {'rank': _rank_analog_grid, 'rmse': _rmse_analog_grid, 'mae': _mae_analog_grid, 'corr': _corr_analog_grid}
+
+
+def synthetic_archive(n_vars,n_dates,n_lats,n_lons,seed=0):
+    """
+    Seeded (n_vars,time,lat,lon) training archive and (n_vars,lat,lon) forecast: smooth-ish random fields, rounded
+    to 0.1 so the rank method sees ties like real (e.g. precipitation) data does.
+    """
+    rng = np.random.RandomState(seed)
+    fields = rng.standard_normal((n_vars,n_dates+1,n_lats,n_lons))
+    # --- A little spatial correlation, so local patterns aren't pure noise
+    fields[...,1:,:] += 0.5*fields[...,:-1,:]
+    fields[...,1:] += 0.5*fields[...,:-1]
+    fields = np.round(fields,1)
+    return fields[:,:-1],fields[:,-1]
+
+
+def measure(func,repeat):
+    """
+    Best wall time over repeat runs, and the peak memory traced during one more run.
+    :return result/seconds/peak_bytes:
+    """
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - t0)
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result,min(times),peak
+
+
+def max_error(result,expected):
+    result = np.asarray(result,dtype=np.float64)
+    expected = np.asarray(expected,dtype=np.float64)
+    both_nan = np.isnan(result) & np.isnan(expected)
+    diffs = np.where(both_nan,0.,np.absolute(result - expected))
+    return float(np.max(diffs)) if diffs.size else 0.
+
+
+def record(name,params,seconds,peak,n_work,error=None,tol=None):
+    rec = {'name': name,
+           'params': params,
+           'seconds': seconds,
+           'throughput': n_work/seconds if seconds > 0 else None,
+           'peak_bytes': peak}
+    if error is not None:
+        rec['max_abs_error'] = error
+        rec['ok'] = bool(error <= tol)
+    return rec
+
+
+def bench_kernels(n_dates,n_lats,n_lons,grid_window,methods,repeat,check,seed):
+    g = grid_window
+    train,forecast = synthetic_archive(1,n_dates,n_lats,n_lons,seed)
+    train,forecast = train[0],forecast[0]
+    dom = (g,n_lats-g-1,g,n_lons-g-1)
+    n_work = (n_lats-2*g)*(n_lons-2*g)*n_dates
+    params = {'n_dates': n_dates, 'grid': [n_lats,n_lons], 'grid_window': g}
+    records = []
+    for meth in methods:
+        run = lambda: kernels[meth](train,forecast,np.zeros(train.shape),dom[0],dom[1],dom[2],dom[3],g)
+        result,seconds,peak = measure(run,repeat)
+        error = None
+        if check:
+            error = max_error(result[:,dom[0]:dom[1]+1,dom[2]:dom[3]+1],
+                              reference.distance_funcs[meth](train,forecast,*dom,grid_window=g)[:,dom[0]:dom[1]+1,
+                                                                                               dom[2]:dom[3]+1])
+        records.append(record('kernel_'+meth,dict(params,comp_method=meth),seconds,peak,n_work,error,1e-8))
+    return records
+
+
+def bench_proba(n_dates,n_lats,n_lons,n_vars,repeat,check,seed,n_analogs=50,pct_samps=0.1):
+    rng = np.random.RandomState(seed)
+    distances = rng.gamma(2.,1.,(n_vars,n_dates,n_lats,n_lons))
+    events = (rng.rand(n_dates,n_lats,n_lons) > 0.7).astype(np.float64)
+    dom = (0,n_lats-1,0,n_lons-1)
+    n_work = n_lats*n_lons*n_dates
+    params = {'n_dates': n_dates, 'grid': [n_lats,n_lons], 'n_vars': n_vars}
+    records = []
+
+    run = lambda: interp_proba(distances,events,*dom,pct_samps=pct_samps)
+    result,seconds,peak = measure(run,repeat)
+    error = max_error(result,reference.interp_proba(distances,events,*dom,pct_samps=pct_samps)) if check else None
+    records.append(record('interp_proba',dict(params,pct_samps=pct_samps),seconds,peak,n_work,error,1e-10))
+
+    total = distances.sum(axis=0)
+    run = lambda: gen_proba_topk(select_analogs(total,*dom,n_analogs=n_analogs)[0],events,*dom,n_analogs=n_analogs)
+    result,seconds,peak = measure(run,repeat)
+    error = max_error(result,reference.topk_proba(total,events,*dom,n_analogs=n_analogs)) if check else None
+    records.append(record('topk_proba',dict(params,n_analogs=n_analogs),seconds,peak,n_work,error,1e-12))
+    return records
+
+
+def bench_rank_update(n_dates,n_lats,n_lons,repeat,check,seed):
+    """
+    Rolling-window updates of a ranked climatology (append only, append and evict, evict only) against ranking the
+    updated archive from scratch. Values are rounded to whole numbers so ties are common.
+    """
+    train = np.round(3.*synthetic_archive(1,n_dates,n_lats,n_lons,seed)[0][0])
+    ranks,sorted_clim = rank_columns(train,return_sorted=True)
+    ranks = compact_ranks(ranks)
+    n_step = max(1,n_dates//20)
+    added = np.round(3.*synthetic_archive(1,n_step,n_lats,n_lons,seed+1)[0][0])
+    n_work = n_lats*n_lons*n_dates
+    params = {'n_dates': n_dates, 'grid': [n_lats,n_lons]}
+    records = []
+    for n_added,n_evict in ((n_step,0),(n_step,n_step),(0,n_step)):
+        new = added[:n_added]
+        run = lambda: update_rank_climatology(train,ranks,sorted_clim,new,n_evict=n_evict)
+        (new_ranks,new_sorted),seconds,peak = measure(run,repeat)
+        error = None
+        if check:
+            exp_ranks,exp_sorted = rank_columns(np.concatenate((train[n_evict:],new)),return_sorted=True)
+            error = max(max_error(new_ranks,compact_ranks(exp_ranks)),max_error(new_sorted,exp_sorted))
+        records.append(record('rank_update',dict(params,n_added=n_added,n_evict=n_evict),seconds,peak,n_work,
+                              error,0.))
+    return records
+
+
+def bench_pipeline(n_dates,n_lats,n_lons,grid_window,n_vars,methods,repeat,check,seed,n_analogs=50):
+    g = grid_window
+    train,forecast = synthetic_archive(n_vars,n_dates,n_lats,n_lons,seed)
+    comp_method = [methods[nvar % len(methods)] for nvar in range(n_vars)]
+    weights = [1.]*n_vars
+    if n_vars == 1:
+        train,forecast = train[0],forecast[0]
+    events = (np.random.RandomState(seed+1).rand(n_dates,n_lats,n_lons) > 0.7).astype(np.float64)
+    dom = (g,n_lats-g-1,g,n_lons-g-1)
+    n_work = (n_lats-2*g)*(n_lons-2*g)*n_dates
+    params = {'n_dates': n_dates, 'grid': [n_lats,n_lons], 'grid_window': g, 'n_vars': n_vars,
+              'comp_method': comp_method, 'n_analogs': n_analogs}
+
+    def run():
+        analog = Analog(grid_window=g,comp_method=comp_method,field_weights=weights,lat_bounds=[0,n_lats-1],
+                        lon_bounds=[0,n_lons-1],forecast_lats=[dom[0],dom[1]],forecast_lons=[dom[2],dom[3]])
+        analog.find_analogs(train,forecast,n_analogs=n_analogs)
+        return analog,analog.gen_forecast(events,n_analogs)
+    (analog,probs),seconds,peak = measure(run,repeat)
+    error = None
+    if check:
+        total = np.zeros((n_dates,n_lats,n_lons))
+        for nvar,meth in enumerate(comp_method):
+            var_train = train if n_vars == 1 else train[nvar]
+            var_fcst = forecast if n_vars == 1 else forecast[nvar]
+            total += weights[nvar]*reference.distance_funcs[meth](var_train,var_fcst,*dom,grid_window=g)
+        # --- Compare the kept distances rather than indices, near-ties can swap places with float rounding
+        ref_dists = reference.top_analogs(total,*dom,n_analogs=n_analogs)[1]
+        error = max_error(analog.analog_distances,ref_dists)
+    return [record('pipeline',params,seconds,peak,n_work,error,1e-6)]
+
+
+def index_error(idxs,dists,expected_idxs,expected_dists):
+    """
+    Number of analog indices that differ, plus the largest distance difference: 0 only if both match exactly.
+    """
+    return float(np.count_nonzero(np.asarray(idxs) != np.asarray(expected_idxs))) + max_error(dists,expected_dists)
+
+
+def write_archives(train,directory,n_tiles=3):
+    """
+    Write train as a directory of .npy time-chunk tiles, and as a netCDF4 (or, without netCDF4, HDF5) file with one
+    (time,lat,lon) variable per training variable if either library is installed.
+    :return paths:
+        dict, reader name to the path to pass to open_archive.
+    """
+    time_axis = train.ndim - 3
+    tile_dir = os.path.join(directory,'tiles')
+    os.mkdir(tile_dir)
+    for ntile,tile in enumerate(np.array_split(train,n_tiles,axis=time_axis)):
+        np.save(os.path.join(tile_dir,'{:03d}.npy'.format(ntile)),tile)
+    paths = {'npy_tiles': tile_dir}
+    variables = [train] if train.ndim == 3 else list(train)
+    try:
+        import netCDF4
+        paths['netcdf4'] = os.path.join(directory,'train.nc')
+        with netCDF4.Dataset(paths['netcdf4'],'w') as f:
+            for dim,size in zip(('time','lat','lon'),variables[0].shape):
+                f.createDimension(dim,size)
+            for nvar,values in enumerate(variables):
+                f.createVariable('v{}'.format(nvar),values.dtype,('time','lat','lon'))[:] = values
+    except ImportError:
+        try:
+            import h5py
+            paths['h5py'] = os.path.join(directory,'train.h5')
+            with h5py.File(paths['h5py'],'w') as f:
+                for nvar,values in enumerate(variables):
+                    f.create_dataset('v{}'.format(nvar),data=values)
+        except ImportError:
+            pass
+    return paths
+
+
+def bench_consistency(n_dates,n_lats,n_lons,grid_window,n_vars,methods,repeat,check,seed,n_analogs=20):
+    """
+    The other ways of running the same search against the plain in-memory find_analogs, on values rounded to
+    whole numbers so ties between training dates are everywhere: streaming in blocks, candidate dates against a
+    copy holding only those dates, station lists against the grid, and on-disk readers against the array. Analog
+    indices have to match exactly, so tie-breaking has to be the same in every path.
+    """
+    g = grid_window
+    train,forecast = synthetic_archive(n_vars,n_dates,n_lats,n_lons,seed)
+    train,forecast = np.round(3.*train),np.round(3.*forecast)
+    comp_method = [methods[nvar % len(methods)] for nvar in range(n_vars)]
+    if n_vars == 1:
+        train,forecast = train[0],forecast[0]
+    dom = (g,n_lats-g-1,g,n_lons-g-1)
+    n_work = (n_lats-2*g)*(n_lons-2*g)*n_dates
+    params = {'n_dates': n_dates, 'grid': [n_lats,n_lons], 'grid_window': g, 'n_vars': n_vars,
+              'comp_method': comp_method, 'n_analogs': n_analogs}
+    make = lambda: Analog(grid_window=g,comp_method=comp_method,lat_bounds=[0,n_lats-1],lon_bounds=[0,n_lons-1],
+                          forecast_lats=[dom[0],dom[1]],forecast_lons=[dom[2],dom[3]])
+    expected = make().find_analogs(train,forecast,n_analogs=n_analogs)
+    records = []
+
+    block_size = max(1,n_dates//7)
+    run = lambda: make().find_analogs(train,forecast,n_analogs=n_analogs,block_size=block_size)
+    analog,seconds,peak = measure(run,repeat)
+    error = index_error(analog.indices,analog.analog_distances,expected.indices,expected.analog_distances) \
+        if check else None
+    records.append(record('blocked',dict(params,block_size=block_size),seconds,peak,n_work,error,0.))
+
+    dates = np.sort(np.random.RandomState(seed+1).choice(n_dates,n_dates//2,replace=False))
+    run = lambda: make().find_analogs(train,forecast,n_analogs=n_analogs,dates=dates)
+    analog,seconds,peak = measure(run,repeat)
+    error = None
+    if check:
+        subset = make().find_analogs(train[dates] if n_vars == 1 else train[:,dates],forecast,n_analogs=n_analogs)
+        subset_idxs = np.where(subset.indices >= 0,dates[np.maximum(subset.indices,0)],-1)
+        error = index_error(analog.indices,analog.analog_distances,subset_idxs,subset.analog_distances)
+    records.append(record('dates',dict(params,n_candidates=len(dates)),seconds,peak,len(dates)*n_work//n_dates,
+                          error,0.))
+
+    # --- A station at every grid point of the forecast domain
+    station_lats,station_lons = [values.ravel() for values in np.meshgrid(expected.all_lats[dom[0]:dom[1]+1],
+                                                                          expected.all_lons[dom[2]:dom[3]+1],
+                                                                          indexing='ij')]
+    run = lambda: make().find_station_analogs(train,forecast,station_lats,station_lons,n_analogs)
+    (station_idxs,station_dists),seconds,peak = measure(run,repeat)
+    error = None
+    if check:
+        grid = (slice(None),slice(dom[0],dom[1]+1),slice(dom[2],dom[3]+1))
+        error = index_error(station_idxs,station_dists,expected.indices[grid].reshape(n_analogs,-1),
+                            expected.analog_distances[grid].reshape(n_analogs,-1))
+    records.append(record('station',params,seconds,peak,n_work,error,1e-9))
+
+    with tempfile.TemporaryDirectory() as directory:
+        for name,path in sorted(write_archives(train,directory).items()):
+            archive = open_archive(path)
+            run = lambda: make().find_analogs(archive,forecast,n_analogs=n_analogs)
+            analog,seconds,peak = measure(run,repeat)
+            if hasattr(archive,'close'):
+                archive.close()
+            error = index_error(analog.indices,analog.analog_distances,expected.indices,expected.analog_distances) \
+                if check else None
+            records.append(record('reader_'+name,params,seconds,peak,n_work,error,0.))
+    return records
+
+
+def environment():
+    versions = {}
+    for name in ('numpy','scipy'):
+        try:
+            versions[name] = __import__(name).__version__
+        except ImportError:
+            versions[name] = None
+    return {'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+            'versions': versions, 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def parse_grid(text):
+    n_lats,n_lons = text.lower().split('x')
+    return int(n_lats),int(n_lons)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__,formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--n-dates',type=int,nargs='+',default=[500,2000])
+    parser.add_argument('--grid',type=parse_grid,nargs='+',default=[(40,50)],help='LATSxLONS, e.g. 40x50')
+    parser.add_argument('--grid-window',type=int,nargs='+',default=[1,3])
+    parser.add_argument('--n-vars',type=int,nargs='+',default=[1,3])
+    parser.add_argument('--methods',nargs='+',default=['rank','rmse','mae'],choices=sorted(kernels))
+    parser.add_argument('--repeat',type=int,default=3)
+    parser.add_argument('--seed',type=int,default=0)
+    parser.add_argument('--no-check',action='store_true',help='skip the (slow) reference comparisons')
+    parser.add_argument('--quick',action='store_true',help='one small case of everything')
+    parser.add_argument('--output',help='JSON file to write, default stdout')
+    args = parser.parse_args(argv)
+    if args.quick:
+        args.n_dates,args.grid,args.grid_window,args.n_vars,args.repeat = [200],[(20,25)],[2],[1,2],1
+
+    check = not args.no_check
+    records = []
+    for n_dates,(n_lats,n_lons) in itertools.product(args.n_dates,args.grid):
+        for g in args.grid_window:
+            records += bench_kernels(n_dates,n_lats,n_lons,g,args.methods,args.repeat,check,args.seed)
+            for n_vars in args.n_vars:
+                records += bench_pipeline(n_dates,n_lats,n_lons,g,n_vars,args.methods,args.repeat,check,args.seed)
+                records += bench_consistency(n_dates,n_lats,n_lons,g,n_vars,args.methods,args.repeat,check,
+                                             args.seed)
+        for n_vars in args.n_vars:
+            records += bench_proba(n_dates,n_lats,n_lons,n_vars,args.repeat,check,args.seed)
+        records += bench_rank_update(n_dates,n_lats,n_lons,args.repeat,check,args.seed)
+
+    for rec in records:
+        sys.stderr.write('{:<14} {:<90} {:9.4f}s {:12.4g} pts*dates/s {:8.1f} MiB {}\n'.format(
+                         rec['name'],json.dumps(rec['params']),rec['seconds'],rec['throughput'],
+                         rec['peak_bytes']/2.**20,{True: 'ok', False: 'MISMATCH'}.get(rec.get('ok'),'')))
+    results = {'environment': environment(), 'results': records}
+    if args.output:
+        with open(args.output,'w') as f:
+            json.dump(results,f,indent=1)
+    else:
+        json.dump(results,sys.stdout,indent=1)
+        sys.stdout.write('\n')
+    return 1 if any(rec.get('ok') is False for rec in records) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+"""
+Slow, obviously-correct reference implementations for checking the pyanalog kernels: one grid point at a time,
+straight from the definitions.
+"""
+
+import numpy as np
+from scipy.stats import rankdata as rd
+
+
+def rank_distances(train,forecast,i_start,i_stop,j_start,j_stop,grid_window):
+    """
+    Summed absolute rank difference, each grid point ranked over the training dates plus the forecast.
+    """
+    g = grid_window
+    ranked = np.concatenate((train,forecast[np.newaxis]))
+    for i in range(i_start-g,i_stop+g+1):
+        for j in range(j_start-g,j_stop+g+1):
+            ranked[:,i,j] = rd(ranked[:,i,j],method='average')
+    out = np.zeros(train.shape)
+    for i in range(i_start,i_stop+1):
+        for j in range(j_start,j_stop+1):
+            box = ranked[:,i-g:i+g+1,j-g:j+g+1]
+            out[:,i,j] = np.sum(np.absolute(box[:-1] - box[-1]),axis=(1,2))
+    return out
+
+
+def rmse_distances(train,forecast,i_start,i_stop,j_start,j_stop,grid_window):
+    g = grid_window
+    out = np.zeros(train.shape)
+    for i in range(i_start,i_stop+1):
+        for j in range(j_start,j_stop+1):
+            diffs = train[:,i-g:i+g+1,j-g:j+g+1] - forecast[i-g:i+g+1,j-g:j+g+1]
+            out[:,i,j] = np.sqrt(np.mean(diffs**2,axis=(1,2)))
+    return out
+
+
+def mae_distances(train,forecast,i_start,i_stop,j_start,j_stop,grid_window):
+    g = grid_window
+    out = np.zeros(train.shape)
+    for i in range(i_start,i_stop+1):
+        for j in range(j_start,j_stop+1):
+            diffs = train[:,i-g:i+g+1,j-g:j+g+1] - forecast[i-g:i+g+1,j-g:j+g+1]
+            out[:,i,j] = np.mean(np.absolute(diffs),axis=(1,2))
+    return out
+
+
+def corr_distances(train,forecast,i_start,i_stop,j_start,j_stop,grid_window):
+    """
+    1 - pattern correlation of each local domain, 1 where a local domain is flat.
+    """
+    g = grid_window
+    out = np.ones(train.shape)
+    for i in range(i_start,i_stop+1):
+        for j in range(j_start,j_stop+1):
+            fcst = forecast[i-g:i+g+1,j-g:j+g+1].ravel()
+            for t in range(train.shape[0]):
+                patch = train[t,i-g:i+g+1,j-g:j+g+1].ravel()
+                if patch.std() > 0 and fcst.std() > 0:
+                    out[t,i,j] = 1. - np.corrcoef(patch,fcst)[0,1]
+    return out
+
+
+distance_funcs = {'rank': rank_distances, 'rmse': rmse_distances, 'mae': mae_distances, 'corr': corr_distances}
+
+
+def top_analogs(distances,i_start,i_stop,j_start,j_stop,n_analogs):
+    """
+    Indices/distances of the n_analogs closest dates at each grid point by a full stable sort (ties go to the
+    earlier date). Only the forecast domain is filled in.
+    """
+    idxs = np.full((n_analogs,)+distances.shape[1:],-1,dtype=np.intp)
+    dists = np.full((n_analogs,)+distances.shape[1:],np.nan)
+    for i in range(i_start,i_stop+1):
+        for j in range(j_start,j_stop+1):
+            order = np.argsort(distances[:,i,j],kind='stable')[:n_analogs]
+            idxs[:,i,j] = order
+            dists[:,i,j] = distances[order,i,j]
+    return idxs,dists
+
+
+def topk_proba(distances,events,i_start,i_stop,j_start,j_stop,n_analogs):
+    idxs = top_analogs(distances,i_start,i_stop,j_start,j_stop,n_analogs)[0]
+    probs = np.zeros(distances.shape[1:])
+    for i in range(i_start,i_stop+1):
+        for j in range(j_start,j_stop+1):
+            probs[i,j] = np.mean(events[idxs[:,i,j],i,j])
+    return probs
+
+
+def interp_proba(distances,events,i_start,i_stop,j_start,j_stop,pct_samps):
+    """
+    Inverse-distance weighted probability over the closest pct_samps of dates, distances min-max scaled per variable
+    and combined into a Euclidean distance.
+    """
+    probs = np.zeros(distances.shape[-2:])
+    with np.errstate(divide='ignore',invalid='ignore'):
+        for i in range(i_start,i_stop+1):
+            for j in range(j_start,j_stop+1):
+                d = distances[:,:,i,j]
+                scaled = (d - d.min(axis=1)[:,np.newaxis])/(d.max(axis=1) - d.min(axis=1))[:,np.newaxis]
+                all_distances = np.sqrt(np.sum(scaled**2,axis=0))
+                max_rad = np.percentile(all_distances,pct_samps*100.)
+                near = np.where(all_distances <= max_rad)[0]
+                weights = ((max_rad - all_distances[near])/(max_rad*all_distances[near]))**2
+                probs[i,j] = np.sum(weights*events[near,i,j])/np.sum(weights)
+    return probs
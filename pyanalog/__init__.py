@@ -1,5 +1,19 @@
 __author__ = 'falvarez'
-from analog import Analog
-from utils import get_analog_dates
+from .utils import get_analog_dates,get_analog_idxs
+from .readers import open_archive
 
-__all__ = ["Analog", "get_analog_dates"]
\ No newline at end of file
+__all__ = ["Analog", "AnalogJob", "LocalScheduler", "get_analog_dates", "get_analog_idxs", "open_archive", "warmup"]
+
+
+def __getattr__(name):
+    # --- Analog (and scipy with it) only loads when it's first used, so date utilities stay cheap to import
+    if name == 'Analog':
+        from .analog import Analog
+        return Analog
+    if name in ('AnalogJob','LocalScheduler'):
+        from . import jobs
+        return getattr(jobs,name)
+    if name == 'warmup':
+        from .comp_funcs import warmup
+        return warmup
+    raise AttributeError("module 'pyanalog' has no attribute {!r}".format(name))
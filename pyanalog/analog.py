@@ -1,15 +1,27 @@
 #!/usr/bin/env python
 
+import os
 import warnings
-from utils import find_nearest_idx
+from contextlib import contextmanager
+from .utils import find_nearest_idx,get_analog_idxs
 import numpy as np
-from comp_funcs import _rank_analog_grid,_rmse_analog_grid,_mae_analog_grid,argsort_analogs,interp_proba,gen_proba
+from scipy.sparse import coo_matrix
+from .comp_funcs import interp_proba,rank_columns,select_analogs,gen_proba_topk,\
+    n_analogs_from_frac,merge_analogs,forecast_ranks,compact_ranks,interp_weights,analog_values,threshold_proba,\
+    weighted_quantiles,update_rank_climatology,halo_box,station_distances
+from .parallel import n_workers,tile_domain,tile_distances,map_tasks,worker_pool
+from .index import build_index,load_index,append_index
+from .approx import PatchSearch
+from .readers import open_archive,prefetch
+from .profiling import Profiler,NULL_STAGE
 
 class Analog(object):
     """Various methods to produce a single deterministic/probabilistic forecast via analog method."""
 
     def __init__(self,grid_window=3, comp_method=['Rank'], field_weights=[],
-                 lat_bounds=[], lon_bounds=[], forecast_lats=[], forecast_lons=[], lat_inc=1., lon_inc=1.,):
+                 lat_bounds=[], lon_bounds=[], forecast_lats=[], forecast_lons=[], lat_inc=1., lon_inc=1.,
+                 n_jobs=1, parallel='threads', keep_var_distances=False, normalize=False, dtype=np.float64,
+                 profile=False, profile_memory=False, crop_output=False,):
         """
         Initialize the analog object.
 
@@ -20,7 +32,8 @@ class Analog(object):
             to calculate differences between forecast/training
             data (3*2 + 1)*(3+2 +1).
         :param comp_method
-            list, Method with which to pattern match. Options: ['Rank','MAE','RMSE',].
+            list, Method with which to pattern match. Options: ['Rank','MAE','RMSE','Corr',].
+            'Corr' uses 1 - the pattern correlation of the local domains.
             if n_vars > 1, can use different methods to compare each variable.
         :param lat_bounds/lon_bounds:
             list or NumPy array
@@ -28,13 +41,53 @@ class Analog(object):
             len(allLats) = forecastData[0] or forecastData[1] if forecastData.shape == 3.
         :param forecast_last/forecast_lons:
             list or NumPy array
-            Either a list/numpy array of min/max forecast lats/lons (defining a domain) or a single point.
+            Either a list/numpy array of min/max forecast lats/lons (defining a domain) or a single point, which is
+            snapped to the nearest grid point. Empty lists use the whole grid. For many scattered points (stations)
+            see find_station_analogs.
         :param lat_inc/lon_inc:
             float
             The change in latitude/longitude each grid point (e.g. dx or dy).
         :param forecast_dates:
             float
             The change in latitude/longitude each grid point (e.g. dx or dy).
+        :param n_jobs:
+            integer
+            Number of cores used by find_analogs. The forecast domain is split into latitude/longitude tiles
+            (each with its own grid_window halo) and tiles/variables are spread across cores.
+            -1 uses every core.
+        :param parallel:
+            string
+            'threads' (default) or 'processes'. Threads share the training data, processes get a copy of each tile.
+        :param keep_var_distances:
+            boolean
+            If True and n_vars > 1, keep the weighted per-variable (n_vars,time,lat,lon) distances in
+            self.distances (needed by gen_forecast(interp=True)). Otherwise each variable is weighted and added
+            straight into self.total_distances and no per-variable array is allocated.
+        :param normalize:
+            boolean
+            If True, rank distances are divided by (2*grid_window+1)**2 * (n_dates+1), the mean absolute rank
+            difference per grid point as a fraction of the archive length, so they're on a 0-1 scale before
+            field_weights are applied and don't grow with grid_window or the archive length.
+        :param dtype:
+            NumPy float type
+            Type of every distance array (np.float32 halves memory and memory traffic). Training data of any type,
+            e.g. float32 or packed int16, is cast inside the kernels; window sums still accumulate in float64.
+        :param profile:
+            boolean or callable
+            If set, time every stage (validate, rank, read, distances, assemble, select, proba, ...) of each
+            find_analogs/find_analogs_batch/gen_forecast/gen_cdf/gen_quantiles call. The CallStats of the last call
+            is kept in self.stats, logged at DEBUG level on the 'pyanalog' logger, and passed to profile if it is
+            callable. Off by default, which costs next to nothing.
+        :param profile_memory:
+            boolean
+            If True, profile and also record each stage's peak allocated bytes with tracemalloc (slower).
+        :param crop_output:
+            boolean
+            The kernels only ever read the forecast domain plus grid_window halo (local domains running off the
+            edge of the grid are clamped to the edge rows/columns), and self.distances/self.total_distances only
+            cover the forecast domain. If True, so do self.indices/self.analog_distances and every
+            gen_forecast/gen_cdf/gen_quantiles output: self.lat_slice/self.lon_slice place them on the full grid
+            (see on_grid()). Otherwise (default) outputs are returned on the full lat_bounds/lon_bounds grid.
         :return: self
         """
 
@@ -66,24 +119,134 @@ class Analog(object):
         self.all_lats = np.arange(lat_bounds[0], lat_bounds[-1] + 1, lat_inc)
         self.all_lons = np.arange(lon_bounds[0], lon_bounds[-1] + 1, lon_inc)
 
-        # --- If we're dealing with a point forecast, we will find the closest lat/lon grid points to the fcst point.
-        if len(forecast_lats) < 1:
-            self.closest_lat = self.all_lats[find_nearest_idx(self.all_lats[:], forecast_lats[0])]
-            self.closest_lon = self.all_lons[find_nearest_idx(self.all_lons[:], forecast_lons[0])]
+        self.forecast_lats = forecast_lats
+        self.forecast_lons = forecast_lons
+        # --- If we're dealing with a point forecast, we will find the closest lat/lon grid points to the fcst point,
+        # --- which then makes up a one grid point forecast domain.
+        if self.point_fcst:
+            self.start_lat_idx = self.stop_lat_idx = int(find_nearest_idx(self.all_lats[:], forecast_lats[0]))
+            self.start_lon_idx = self.stop_lon_idx = int(find_nearest_idx(self.all_lons[:], forecast_lons[0]))
+            self.closest_lat = self.all_lats[self.start_lat_idx]
+            self.closest_lon = self.all_lons[self.start_lon_idx]
+        # --- No forecast domain (e.g. only forecasting for stations with find_station_analogs): use the whole grid
+        elif len(forecast_lats) == 0:
+            self.start_lat_idx,self.stop_lat_idx = 0,self.all_lats.shape[0]-1
+            self.start_lon_idx,self.stop_lon_idx = 0,self.all_lons.shape[0]-1
         # --- If not, we want to find a starting/stopping lat/lon indices to generate a domain-based forecast
         else:
-            self.forecast_lats = forecast_lats
-            self.forecast_lons = forecast_lons
-            self.start_lat_idx = np.where(forecast_lats[0] == self.all_lats)[0]
-            self.start_lon_idx = np.where(forecast_lons[0] == self.all_lons)[0]
-            self.stop_lat_idx = np.where(forecast_lats[1] == self.all_lats)[0]
-            self.stop_lon_idx = np.where(forecast_lons[1] == self.all_lons)[0]
+            self.start_lat_idx = int(np.where(forecast_lats[0] == self.all_lats)[0][0])
+            self.start_lon_idx = int(np.where(forecast_lons[0] == self.all_lons)[0][0])
+            self.stop_lat_idx = int(np.where(forecast_lats[1] == self.all_lats)[0][0])
+            self.stop_lon_idx = int(np.where(forecast_lons[1] == self.all_lons)[0][0])
+        # --- Where the forecast domain sits on the full grid
+        self.lat_slice = slice(self.start_lat_idx,self.stop_lat_idx+1)
+        self.lon_slice = slice(self.start_lon_idx,self.stop_lon_idx+1)
 
         # --- Great, it passed! Let's add in some more info for our own edification
         self.lat_bounds = lat_bounds
         self.lon_bounds = lon_bounds
         self.lat_inc = lat_inc
         self.lon_inc = lon_inc
+        if parallel not in ('threads','processes'):
+            raise ValueError("parallel must be 'threads' or 'processes', not {}".format(parallel))
+        self.n_jobs = n_jobs
+        self.parallel = parallel
+        self.keep_var_distances = keep_var_distances
+        self.normalize = normalize
+        if np.dtype(dtype).kind != 'f':
+            raise ValueError("dtype must be a floating point type, not {}".format(np.dtype(dtype)))
+        self.dtype = np.dtype(dtype)
+        self.crop_output = crop_output
+
+        # --- Ranked training climatology, kept around while the same training array is passed in
+        self._ranked_train = None
+        self._train_ranks = {}
+        self._subset_ranks = {}
+        self.n_analogs = None
+        self.indices = None
+        self.analog_distances = None
+        self.distances = None
+        self.total_distances = None
+        self.index = None
+        self._patch_search = None
+        self._patch_search_train = None
+        self.date_idxs = None
+        self.station_indices = None
+        self._station_train = None
+        self._station_clim = {}
+        self._profiler = None
+        self._pool = None
+        # --- Training archive opened for a path passed as train, and the (path,mtime) it was opened for
+        self._archive = None
+        self._archive_key = None
+        if profile or profile_memory:
+            self._profiler = Profiler(callback=profile if callable(profile) else None,track_memory=profile_memory)
+
+
+    @property
+    def stats(self):
+        """
+        CallStats of the last profiled find_analogs/find_analogs_batch/gen_forecast/gen_cdf/gen_quantiles call,
+        None if profiling is off.
+        """
+        return None if self._profiler is None else self._profiler.last
+
+
+    def _profile_call(self, name, n_points=None):
+        if self._profiler is None:
+            return NULL_STAGE
+        if n_points is None:
+            n_points = (self.stop_lat_idx-self.start_lat_idx+1)*(self.stop_lon_idx-self.start_lon_idx+1)
+        return self._profiler.call(name,n_points)
+
+
+    @contextmanager
+    def _worker_pool(self):
+        """
+        Keep one pool of n_jobs workers in self._pool for the length of a find_analogs/find_analogs_batch call, so
+        every block and forecast reuses it instead of starting its own.
+        """
+        if self._pool is not None:
+            yield self._pool
+            return
+        self._pool = worker_pool(self.n_jobs,self.parallel)
+        try:
+            yield self._pool
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown()
+            self._pool = None
+
+
+    def _open_train(self, train):
+        """
+        train, or if it is a path the archive open_archive() gives for it. That archive is kept open and reused while
+        the same, unchanged path is passed, so the ranked climatology and approximate search built on it are reused
+        too, and closed once a different path is passed (or by close()).
+        """
+        if not isinstance(train,str):
+            return train
+        key = (os.path.abspath(train),os.stat(train).st_mtime_ns)
+        if key != self._archive_key:
+            self.close()
+            self._archive = open_archive(train)
+            self._archive_key = key
+        return self._archive
+
+
+    def close(self):
+        """
+        Close the training archive kept open for a path passed as train, if any.
+        """
+        if self._archive is not None and hasattr(self._archive,'close'):
+            self._archive.close()
+        self._archive,self._archive_key = None,None
+
+
+    def _stage(self, name):
+        if self._profiler is None:
+            return NULL_STAGE
+        return self._profiler.stage(name)
 
 
     def __repr__(self):
@@ -98,17 +261,146 @@ class Analog(object):
                              self.lon_bounds, self.forecast_lats, self.forecast_lons, self.lat_inc, self.lon_inc)
 
 
-    def find_analogs(self, train, forecast):
+    def build_index(self, train, path, block_size=256):
         """
-        Used to find analogs for a single forecast domain.
-        :param forecast:
-            NumPy array, Either a 2-d (lat,lon) or 3-d (n_vars,lat,lon) numpy array of "current" forecast data.
+        Precompute the training-side work for this Analog's domain, grid_window and methods (rank climatologies,
+        windowed sums/sums of squares) and write it to disk as an analog index. The index is attached to self.
         :param train:
-            NumPy array, Either a 3-d (time,lat,lon) or 4-d (n_vars,time,lat,lon) numpy array of "past"/training data.
-        :return analog_idxs:
-            NumPy array, indices of closest analogs, from best pattern match to worst. Same shape as train array.
+            NumPy array (or memory-mapped/chunked array-like), the fixed training archive.
+        :param path:
+            string, directory to write the index to.
+        :return index:
+            AnalogIndex
         """
+        self.index = build_index(self,train,path,block_size=block_size)
+        return self.index
+
 
+    def load_index(self, path):
+        """
+        Attach an analog index written by build_index(), memory-mapped, so find_analogs only does the
+        forecast-dependent work. Raises ValueError if it was built for a different grid_window or domain.
+        :param path:
+            string, index directory.
+        :return index:
+            AnalogIndex
+        """
+        index = load_index(path)
+        if (index.grid_window != self.grid_window or index.lat_box != (self.start_lat_idx,self.stop_lat_idx) or
+                index.lon_box != (self.start_lon_idx,self.stop_lon_idx)):
+            raise ValueError("Analog index at {} was built for a different grid_window or forecast domain.".format(path))
+        self.index = index
+        return self.index
+
+
+    def _use_index(self, train):
+        """
+        True if an analog index is attached and was built from a training array shaped like train.
+        """
+        return self.index is not None and self.index.matches(self,train.shape)
+
+
+    def _rank_climatology(self, train, nvar=None, dates=None):
+        """
+        Ranks of the training data over the forecast domain plus grid_window halo. These only depend on the training
+        data, so they are computed once and reused for every forecast matched against the same train array.
+        :param train:
+            NumPy array, training data passed to find_analogs. Must not be modified in place between calls.
+        :param nvar:
+            integer, variable index into a 4-d train array, or None for a 3-d array.
+        :param dates:
+            sorted integer NumPy array, optional. Rank within these training dates only (the candidate dates of a
+            find_analogs call), as if train held nothing else. The latest set per variable is kept.
+        :return train_ranks:
+            NumPy array, 3-d (time,lat,lon) ranks of the local domain, doubled as unsigned integers (compact_ranks()).
+            Covers dates only if given.
+        :return sorted_clim:
+            NumPy array, 3-d (time,lat,lon) training values of the local domain, sorted along time.
+        """
+        if self._ranked_train is not train:
+            self._ranked_train = train
+            self._train_ranks = {}
+            self._subset_ranks = {}
+        if dates is not None:
+            cached = self._subset_ranks.get(nvar)
+            if cached is None or not np.array_equal(cached[0],dates):
+                ranks,sorted_clim = rank_columns(self._halo(train,(dates,) if nvar is None else (nvar,dates)),
+                                                 return_sorted=True)
+                self._subset_ranks[nvar] = (dates,compact_ranks(ranks),sorted_clim)
+            return self._subset_ranks[nvar][1:]
+        if self._use_index(train) and self.index.get('ranks',nvar) is not None:
+            return self.index.get('ranks',nvar),self.index.get('sorted',nvar)
+        if nvar not in self._train_ranks:
+            ranks,sorted_clim = rank_columns(self._halo(train,(slice(None),) if nvar is None else (nvar,slice(None))),
+                                             return_sorted=True)
+            self._train_ranks[nvar] = (compact_ranks(ranks),sorted_clim)
+        return self._train_ranks[nvar]
+
+
+    def append_train(self, train, new_train, n_evict=0, updated_train=None):
+        """
+        Add new training dates to the end of the archive, optionally dropping the oldest n_evict dates for a rolling
+        window. The training-side state (cached rank climatologies, an attached analog index) is updated for just
+        the added/dropped dates instead of being rebuilt on the next find_analogs call.
+        :param train:
+            NumPy array (or memory-mapped/chunked array-like), the training archive used so far.
+        :param new_train:
+            NumPy array, 3-d (n_new,lat,lon) or 4-d (n_vars,n_new,lat,lon) data for the new training dates.
+        :param n_evict:
+            integer, number of oldest training dates to drop.
+        :param updated_train:
+            array-like, optional, the updated archive (train without its n_evict oldest dates, then new_train),
+            e.g. already appended on disk and memory-mapped or opened with open_archive(). Nothing else of the
+            archive is copied then. Required unless train is an in-memory NumPy array, which is otherwise copied
+            into the updated archive.
+        :return train:
+            the updated archive (updated_train if given). Pass it to find_analogs from now on.
+        """
+        if len(new_train.shape) != len(train.shape) or (len(train.shape) == 4 and new_train.shape[0] != train.shape[0]):
+            raise ValueError("new_train needs the same number of dimensions/variables as train.")
+        if tuple(new_train.shape[-2:]) != tuple(train.shape[-2:]):
+            raise ValueError("new_train lat/lon shape {} doesn't match train {}.".format(new_train.shape[-2:],
+                                                                                        train.shape[-2:]))
+        if not 0 <= n_evict < train.shape[-3] + new_train.shape[-3]:
+            raise ValueError("Can't drop {} of {} training dates.".format(n_evict,train.shape[-3]+new_train.shape[-3]))
+        time_axis = len(train.shape) - 3
+        if updated_train is not None:
+            updated_shape = list(train.shape)
+            updated_shape[time_axis] += new_train.shape[time_axis] - n_evict
+            if tuple(updated_train.shape) != tuple(updated_shape):
+                raise ValueError("updated_train has shape {}, expected {}.".format(updated_train.shape,
+                                                                                 tuple(updated_shape)))
+            updated = updated_train
+        elif type(train) is np.ndarray:
+            kept = train[n_evict:] if time_axis == 0 else train[:,n_evict:]
+            updated = np.concatenate((kept,np.asarray(new_train)),axis=time_axis)
+        else:
+            # --- Copying a memory-mapped/on-disk archive into memory would cost far more than the update itself
+            raise ValueError("Pass the updated archive as updated_train (e.g. appended on disk) for a {} "
+                             "archive.".format(type(train).__name__))
+
+        if self._use_index(train):
+            self.index = append_index(self,self.index,train,new_train,n_evict=n_evict)
+        if self._ranked_train is train and self._train_ranks:
+            for nvar,(ranks,sorted_clim) in self._train_ranks.items():
+                key = (slice(None),) if nvar is None else (nvar,slice(None))
+                self._train_ranks[nvar] = update_rank_climatology(self._halo(train,key),ranks,sorted_clim,
+                                                                  self._halo(new_train,key),n_evict=n_evict)
+            self._ranked_train = updated
+        # --- Candidate-date ranks are keyed by date indices, which shift with the archive
+        self._subset_ranks = {}
+        # --- The EOF basis and KD-trees are fit to the old archive
+        self._patch_search = None
+        self._patch_search_train = None
+        return updated
+
+
+    def _check_inputs(self, train, forecast):
+        """
+        Make sure everything is copacetic between the forecast/train array shapes and the domain.
+        :return n_vars:
+            integer, number of variables.
+        """
         # --- Here, we check to make sure everything is copacetic between the forecast/train array shapes
         # --- and other pre-defined variables
         if (len(forecast.shape) > 2) and (forecast.shape[0] > 1):
@@ -125,9 +417,9 @@ class Analog(object):
             n_vars = 1
 
         if n_vars == 1:
-            if self.all_lats.shape[0] != train.shape[0]:
+            if self.all_lats.shape[0] != train.shape[1]:
                  raise ValueError("Number of latitude grid points from domain boundaries doesn't equal that in training data.")
-            if self.all_lons.shape[0] != train.shape[1]:
+            if self.all_lons.shape[0] != train.shape[2]:
                  raise ValueError("Number of longitude grid points from domain boundaries doesn't equal that in training data.")
 
             if self.all_lats.shape[0] != forecast.shape[0]:
@@ -144,59 +436,685 @@ class Analog(object):
                  raise ValueError("Number of latitude grid points from domain boundaries doesn't equal that in forecast data.")
             if self.all_lons.shape[0] != forecast.shape[-1]:
                  raise ValueError("Number of longitude grid points from domain boundaries doesn't equal that in forecast data.")
+        return n_vars
+
+
+    def _halo(self, array, key=()):
+        """
+        array[key] over the forecast domain plus grid_window halo, edge-clamped at the grid boundary (halo_box()).
+        """
+        return halo_box(array,key,self.start_lat_idx,self.stop_lat_idx,self.start_lon_idx,self.stop_lon_idx,
+                        self.grid_window)
 
 
+    def _read_box(self, train, n_vars, times):
+        """
+        Read the training dates times over the forecast domain plus grid_window halo, every variable, into memory.
+        """
+        return self._halo(train,(times,) if n_vars == 1 else (slice(None),times))
+
+
+    def _var_weights(self, n_vars, n_dates):
+        """
+        Per-variable weights, with the rank normalisation folded in.
+        """
+        weights = []
+        for nvar,meth in enumerate(self.comp_method[:n_vars]):
+            weight = 1. if n_vars == 1 or nvar >= len(self.field_weights) else self.field_weights[nvar]
+            if self.normalize and meth == 'rank':
+                weight /= ((2*self.grid_window+1)**2)*(n_dates+1.)
+            weights.append(weight)
+        return weights
+
+
+    def _find_distances(self, train, forecast, n_vars, reuse=False, times=slice(None), block=None,
+                        rank_dates=None):
+        """
+        Fill self.total_distances (weighted sum over variables) over the forecast domain for one forecast, and
+        self.distances (per variable, weighted) if keep_var_distances is set. Each variable's distances are weighted and added
+        into the total as they are found, so no (n_vars,time,lat,lon) array is needed otherwise.
+        :param reuse:
+            boolean, if True overwrite the existing distance arrays in place when their shape matches,
+            rather than allocating new ones (used when looping over a batch of forecasts).
+        :param times:
+            slice or sorted integer array, optional block/subset of training dates to compare against. Only those
+            dates (and only the forecast domain plus halo) are read from train, so train can be a memory-mapped or
+            chunked array.
+        :param block:
+            NumPy array, optional. The times dates already read by _read_box() (e.g. prefetched), used instead of
+            reading train.
+        :param rank_dates:
+            sorted integer NumPy array, optional. The candidate dates ranks are taken within (times has to be a
+            subset of them), otherwise ranks are taken against the whole training climatology.
+        """
+        n_all_dates = train.shape[0] if n_vars == 1 else train.shape[1]
+        n_times = len(range(*times.indices(n_all_dates))) if isinstance(times,slice) else len(times)
+        # --- Only the forecast domain is allocated, whatever the size of the full grid
+        shape = (n_times,)+self._domain_shape()
+        keep_vars = self.keep_var_distances and n_vars > 1
         # --- Pre-generating analog indices array, this should be faster.
-        self.distances = np.zeros(train.shape)
-        # --- Now, let's find the closest analogs
-        if n_vars == 1: # --- Only doing a single field
-            if self.comp_method[0] == 'rank':
-                _rank_analog_grid(train,forecast,self.distances,self.start_lat_idx,self.stop_lat_idx,
-                                  self.start_lon_idx,self.stop_lon_idx, self.grid_window)
-            elif self.comp_method[0] == 'rmse':
-                _rmse_analog_grid(self.train,self.forecast,self.distances,self.start_lat_idx,self.stop_lat_idx,
-                                  self.start_lon_idx,self.stop_lon_idx, self.grid_window)
-            elif self.comp_method[0] == 'mae':
-                _mae_analog_grid(self.train,self.forecast,self.distances,self.start_lat_idx,self.stop_lat_idx,
-                                  self.start_lon_idx,self.stop_lon_idx, self.grid_window)
-            self.total_distances = self.distances
-        elif n_vars > 1:
-            for nvar,meth in enumerate(self.comp_method):
-                #print "Finding analogs for variable #{}: method {}".format(nvar+1,meth)
+        if not reuse or self.total_distances is None or self.total_distances.shape != shape:
+            self.total_distances = np.zeros(shape,dtype=self.dtype)
+        if not keep_vars:
+            self.distances = self.total_distances if n_vars == 1 else None
+        elif not reuse or self.distances is None or self.distances.shape != (n_vars,)+shape:
+            self.distances = np.zeros((n_vars,)+shape,dtype=self.dtype)
+
+        g = self.grid_window
+        methods = self.comp_method[:n_vars]
+        weights = self._var_weights(n_vars,n_all_dates if rank_dates is None else len(rank_dates))
+        # --- Rows of the ranked climatology holding the times dates
+        rank_times = times if rank_dates is None else np.searchsorted(rank_dates,times)
+
+        # --- Training-side statistics covering the whole domain + halo
+        fcst_vars = [forecast if n_vars == 1 else forecast[nvar,...] for nvar in range(len(methods))]
+        with self._stage('rank'):
+            var_stats = []
+            for nvar,meth in enumerate(methods):
+                var = None if n_vars == 1 else nvar
+                stats = {}
+                if meth == 'rank':
+                    # --- Forecast ranks come from the whole (candidate) climatology, even when only a block of
+                    # --- dates is compared
+                    stats['train_ranks'],sorted_clim = self._rank_climatology(train,var,rank_dates)
+                    stats['fcst_ranks'] = forecast_ranks(sorted_clim,self._halo(fcst_vars[nvar]))
+                elif meth == 'rmse' and self._use_index(train):
+                    stats['train_sumsq'] = self.index.get('sumsq',var)
+                elif meth == 'corr' and self._use_index(train):
+                    stats['train_sum'] = self.index.get('sum',var)
+                    stats['train_sumsq'] = self.index.get('sumsq',var)
+                var_stats.append(stats)
+
+        # --- Now, let's find the closest analogs: one task per forecast-domain tile. Each tile carries its own
+        # --- grid_window halo, so tiles are independent and can run on separate cores.
+        if n_workers(self.n_jobs) > 1:
+            tiles = tile_domain(self.start_lat_idx,self.stop_lat_idx,self.start_lon_idx,self.stop_lon_idx,
+                                2*n_workers(self.n_jobs))
+        else:
+            tiles = [(self.start_lat_idx,self.stop_lat_idx,self.start_lon_idx,self.stop_lon_idx)]
+        with self._stage('read'):
+            tasks = []
+            for i0,i1,j0,j1 in tiles:
+                # --- Statistics over the domain + halo (ranks) or the domain only (windowed sums), under this tile
+                halo_idx = (times,slice(i0-self.start_lat_idx,i1-self.start_lat_idx+2*g+1),
+                            slice(j0-self.start_lon_idx,j1-self.start_lon_idx+2*g+1))
+                dom_idx = (times,slice(i0-self.start_lat_idx,i1-self.start_lat_idx+1),
+                           slice(j0-self.start_lon_idx,j1-self.start_lon_idx+1))
+                train_boxes,fcst_boxes,tile_stats = [],[],[]
+                for nvar,meth in enumerate(methods):
+                    #print "Finding analogs for variable #{}: method {}".format(nvar+1,meth)
+                    if block is not None:
+                        tile_box = (slice(None),)+halo_idx[1:]
+                        train_boxes.append(block[tile_box if n_vars == 1 else (nvar,)+tile_box])
+                    else:
+                        # --- Index train in one go, so array-likes (memmap, h5py, ...) only read this tile's box
+                        key = (times,) if n_vars == 1 else (nvar,times)
+                        train_boxes.append(halo_box(train,key,i0,i1,j0,j1,g))
+                    fcst_boxes.append(halo_box(fcst_vars[nvar],(),i0,i1,j0,j1,g))
+                    stats = {}
+                    for name,data in var_stats[nvar].items():
+                        if name == 'fcst_ranks':
+                            stats[name] = data[halo_idx[1:]]
+                        elif name == 'train_ranks':
+                            stats[name] = np.asarray(data[(rank_times,)+halo_idx[1:]])
+                        else:
+                            stats[name] = np.asarray(data[dom_idx])
+                    tile_stats.append(stats)
+                tasks.append((methods,train_boxes,fcst_boxes,g,weights,tile_stats,keep_vars,self.dtype))
+
+        with self._stage('distances'):
+            results = map_tasks(tile_distances,tasks,self.n_jobs,self.parallel,pool=self._pool)
+        with self._stage('assemble'):
+            for (i0,i1,j0,j1),(total,var_dists) in zip(tiles,results):
+                lats = slice(i0-self.start_lat_idx,i1-self.start_lat_idx+1)
+                lons = slice(j0-self.start_lon_idx,j1-self.start_lon_idx+1)
+                self.total_distances[:,lats,lons] = total
+                if keep_vars:
+                    for nvar,dists in enumerate(var_dists):
+                        self.distances[nvar,:,lats,lons] = dists
+        if self._profiler is not None:
+            self._profiler.count_dates(n_times)
+
+
+    def _date_selection(self, dates, n_dates):
+        """
+        Turn a find_analogs dates argument (boolean mask or indices of the training time axis) into sorted unique
+        indices, or None to use every training date.
+        """
+        if dates is None:
+            return None
+        dates = np.asarray(dates)
+        if dates.dtype == bool:
+            if dates.shape != (n_dates,):
+                raise ValueError("Boolean dates mask has shape {}, the training archive has {} dates.".format(
+                                 dates.shape,n_dates))
+            return np.flatnonzero(dates)
+        dates = np.unique(dates.astype(np.intp))
+        if dates.size and (dates[0] < 0 or dates[-1] >= n_dates):
+            raise ValueError("dates has to index the {} training dates.".format(n_dates))
+        return dates
+
+
+    def _domain_shape(self):
+        return self.stop_lat_idx-self.start_lat_idx+1,self.stop_lon_idx-self.start_lon_idx+1
+
+
+    def _domain(self):
+        """
+        Bounds of the forecast domain within the domain-only arrays (self.total_distances, ...).
+        """
+        return 0,self._domain_shape()[0]-1,0,self._domain_shape()[1]-1
+
+
+    def _crop(self, array):
+        """
+        The forecast domain of a (...,lat,lon) array given on either the full grid or just the forecast domain.
+        """
+        if tuple(array.shape[-2:]) == (self.all_lats.shape[0],self.all_lons.shape[0]):
+            return array[...,self.lat_slice,self.lon_slice]
+        if tuple(array.shape[-2:]) != self._domain_shape():
+            raise ValueError("Array lat/lon shape {} is neither the full grid {} nor the forecast domain {}.".format(
+                             array.shape[-2:],(self.all_lats.shape[0],self.all_lons.shape[0]),self._domain_shape()))
+        return array
+
+
+    def on_grid(self, values, fill=0.):
+        """
+        Place (...,lat,lon) forecast-domain values on the full lat_bounds/lon_bounds grid.
+        :param fill:
+            value outside the forecast domain.
+        """
+        out = np.full(values.shape[:-2]+(self.all_lats.shape[0],self.all_lons.shape[0]),fill,dtype=values.dtype)
+        out[...,self.lat_slice,self.lon_slice] = values
+        return out
+
+
+    def _output(self, values, fill=0.):
+        """
+        Forecast-domain values as returned to the user, see crop_output.
+        """
+        return values if self.crop_output else self.on_grid(values,fill)
+
+
+    def _regional(self, values):
+        """
+        Forecast domain of an output made by _output().
+        """
+        return values if self.crop_output else values[...,self.lat_slice,self.lon_slice]
+
+
+    def _full_axis(self, analog_idxs):
+        """
+        Map analog indices into the selected training dates back onto the full training time axis.
+        """
+        if self.date_idxs is None:
+            return analog_idxs
+        return np.where(analog_idxs >= 0,self.date_idxs[np.maximum(analog_idxs,0)],-1)
+
+
+    def find_analogs(self, train, forecast, n_analogs=None, block_size=None, search='exact', n_candidates=None,
+                     n_components=6, dates=None, read_ahead=1, full_climatology=False):
+        """
+        Used to find analogs for a single forecast domain.
+        :param forecast:
+            NumPy array, Either a 2-d (lat,lon) or 3-d (n_vars,lat,lon) numpy array of "current" forecast data.
+        :param train:
+            NumPy array, Either a 3-d (time,lat,lon) or 4-d (n_vars,time,lat,lon) numpy array of "past"/training data.
+            Can also be a memory-mapped array (np.memmap, np.load(..., mmap_mode='r')), any chunked array-like that
+            supports .shape and slicing (h5py, zarr, ...), or a path passed to open_archive(): a .npy file
+            (memory-mapped), a directory of .npy time-chunk tiles or a netCDF4/HDF5 file (every (time,lat,lon)
+            variable; use pyanalog.readers.open_archive(path,variables=...) to pick some). Only the forecast domain
+            plus grid_window halo is read. The archive opened for a path stays open for later calls with the same
+            path (see close()).
+        :param n_analogs:
+            integer, optional. If given, only the n_analogs closest training dates are kept at each grid point
+            (or if < 1, that fraction of training dates), found by partial selection rather than a full sort.
+            self.indices/self.analog_distances are then compact 3-d (n_analogs,lat,lon) arrays, best match first.
+        :param block_size:
+            integer, optional. Stream the training dates in blocks of this many dates, keeping only a running
+            set of the n_analogs best analogs, so peak memory is set by block_size rather than archive length.
+            Requires n_analogs. self.distances/self.total_distances are not kept in this mode. The rank method
+            still holds the ranked climatology of the forecast domain plus halo in memory.
+        :param read_ahead:
+            integer, number of blocks read ahead in a background thread when streaming with block_size, so reading
+            train from disk overlaps with computing distances. 0 reads each block when it's needed.
+        :param search:
+            string, 'exact' (default) scans every training date. 'approx' projects local patches onto
+            n_components EOFs fitted on the training archive, takes n_candidates dates per grid point from a
+            KD-tree in that space, and re-ranks them with the exact comp_method distances. The fitted search
+            is reused while the same train array is passed. Requires n_analogs.
+        :param n_candidates:
+            integer, candidates re-ranked per grid point when search='approx'. Defaults to 4*n_analogs.
+        :param n_components:
+            integer, number of EOFs when search='approx'.
+        :param dates:
+            NumPy array, optional candidate training dates: either integer indices into the training time axis
+            (e.g. from get_analog_idxs()) or a boolean mask over it. Only those dates are read and compared, and
+            self.indices still refer to the full training time axis. self.distances/self.total_distances only
+            cover the candidate dates (self.date_idxs), which gen_forecast takes into account. The rank method ranks
+            within the candidate dates too, so e.g. a held-out year doesn't leak into the ranks.
+        :param full_climatology:
+            boolean, if True the rank method ranks against every training date even when dates is given, sharing
+            one ranked climatology across calls with different candidate dates.
+        :return self:
+            the Analog object. With n_analogs, self.indices holds the training date indices of the closest analogs,
+            3-d (n_analogs,lat,lon) from best pattern match to worst, over the forecast domain (cropped, or on the
+            full grid filled with -1 if crop_output is False), and self.analog_distances their distances. Without
+            it, self.indices is None and only self.total_distances/self.distances are kept.
+        """
+        with self._profile_call('find_analogs'),self._worker_pool():
+            train = self._open_train(train)
+
+            with self._stage('validate'):
+                n_vars = self._check_inputs(train,forecast)
+                self.date_idxs = self._date_selection(dates,train.shape[0] if n_vars == 1 else train.shape[1])
+            self.n_analogs = n_analogs
+            # --- Nothing from a previous call is left behind, e.g. when n_analogs is None this time
+            self.indices,self.analog_distances = None,None
+            if search not in ('exact','approx'):
+                raise ValueError("search must be 'exact' or 'approx', not {}".format(search))
+            if search == 'approx':
+                if n_analogs is None:
+                    raise ValueError("search='approx' needs n_analogs.")
+                if self.date_idxs is not None:
+                    raise ValueError("search='approx' can't be limited to candidate dates, use search='exact'.")
+                if (self._patch_search is None or self._patch_search_train is not train or
+                        self._patch_search.n_components != n_components):
+                    with self._stage('approx_fit'):
+                        self._patch_search = PatchSearch(self,n_components=n_components).fit(train,n_vars)
+                    self._patch_search_train = train
+                with self._stage('approx_query'):
+                    idxs,dists = self._patch_search.query(train,forecast,n_vars,n_analogs,n_candidates)
+                self.indices,self.analog_distances = self._output(idxs,-1),self._output(dists,np.nan)
+                self.distances,self.total_distances = None,None
+                return self
+            rank_dates = None if full_climatology else self.date_idxs
+            if block_size is None:
+                self._find_distances(train,forecast,n_vars,times=slice(None) if self.date_idxs is None else self.date_idxs,
+                                     rank_dates=rank_dates)
+            elif n_analogs is None:
+                raise ValueError("block_size needs n_analogs, the full distances aren't kept when streaming.")
+            else:
+                n_dates = train.shape[0] if n_vars == 1 else train.shape[1]
+                if self.date_idxs is not None:
+                    n_dates = len(self.date_idxs)
+                n_keep = n_analogs_from_frac(n_analogs,n_dates)
+                starts = range(0,n_dates,block_size)
+                block_times = [slice(t0,min(t0+block_size,n_dates)) for t0 in starts]
+                if self.date_idxs is not None:
+                    block_times = [self.date_idxs[times] for times in block_times]
+                # --- The next block's domain + halo is read while this one's distances are computed
+                blocks = prefetch(lambda times: self._read_box(train,n_vars,times),block_times,depth=read_ahead)
+                for t0,times,block in zip(starts,block_times,blocks):
+                    self._find_distances(train,forecast,n_vars,reuse=True,times=times,block=block,
+                                         rank_dates=rank_dates)
+                    with self._stage('select'):
+                        self.indices,self.analog_distances = merge_analogs(self.indices,self.analog_distances,
+                                                                           self.total_distances,t0,*self._domain(),
+                                                                           n_analogs=n_keep)
+                self.indices = self._output(self._full_axis(self.indices),-1)
+                self.analog_distances = self._output(self.analog_distances,np.nan)
+                self.distances,self.total_distances = None,None
+                return self
+
+            if n_analogs is not None:
+                with self._stage('select'):
+                    idxs,dists = select_analogs(self.total_distances,*self._domain(),n_analogs=n_analogs)
+                    self.indices,self.analog_distances = self._output(self._full_axis(idxs),-1),self._output(dists,np.nan)
+
+            return self
+
+
+    def find_analogs_batch(self, train, forecasts, n_analogs, train_dates=None, forecast_dates=None, window=1,
+                           byear=None, eyear=None, all_dates=False, month_range=True, full_climatology=False):
+        """
+        Used to find analogs for many forecast dates in one call, e.g. for hindcast verification. Input checks and
+        the distance buffers are shared across the whole batch, and so is the ranked training climatology unless
+        each forecast has its own candidate dates.
+        :param train:
+            NumPy array, Either a 3-d (time,lat,lon) or 4-d (n_vars,time,lat,lon) numpy array of "past"/training data.
+        :param forecasts:
+            NumPy array, Either a 3-d (n_forecasts,lat,lon) or 4-d (n_forecasts,n_vars,lat,lon) stack of forecasts.
+        :param n_analogs:
+            integer number of analogs to keep per grid point, or if < 1 the fraction of training dates to keep.
+        :param train_dates/forecast_dates:
+            lists of datetime objects, optional. If both are given, each forecast only considers the training
+            dates get_analog_dates() allows for it (seasonal window plus leave-one-year-out cross validation).
+            The rank method ranks within each forecast's allowed dates.
+        :param window/byear/eyear/all_dates/month_range:
+            passed on to get_analog_idxs(). byear/eyear default to the first/last training year.
+        :param full_climatology:
+            boolean, if True the rank method ranks against the full training archive instead, so one ranked
+            climatology is shared by every forecast.
+        :return analog_idxs:
+            NumPy array, 4-d (n_forecasts,n_analogs,lat,lon) training date indices, best match first.
+        :return analog_dists:
+            NumPy array, 4-d (n_forecasts,n_analogs,lat,lon) distances of those analogs.
+        """
+        with self._profile_call('find_analogs_batch'),self._worker_pool():
+            if (train_dates is None) != (forecast_dates is None):
+                raise ValueError("Need both train_dates and forecast_dates to apply cross validation rules.")
+            if forecast_dates is not None:
+                if len(forecast_dates) != forecasts.shape[0]:
+                    raise ValueError("Number of forecast_dates doesn't equal number of forecasts.")
+                train_days = np.array(train_dates,dtype='datetime64[D]')
+
+            with self._stage('validate'):
+                n_vars = self._check_inputs(train,forecasts[0])
+            n_dates = train.shape[0] if n_vars == 1 else train.shape[1]
+            n_keep = n_analogs_from_frac(n_analogs,n_dates)
+            out_shape = self._domain_shape() if self.crop_output else tuple(forecasts.shape[-2:])
+            analog_idxs = np.full((forecasts.shape[0],n_keep)+out_shape,-1,dtype=np.intp)
+            analog_dists = np.full((forecasts.shape[0],n_keep)+out_shape,np.nan)
+            for nfcst in range(forecasts.shape[0]):
+                self.date_idxs = None
+                if forecast_dates is not None:
+                    # --- Only compare against the training dates this forecast is allowed to use
+                    with self._stage('dates'):
+                        self.date_idxs = get_analog_idxs(forecast_dates[nfcst],train_days,window,byear,eyear,
+                                                         all_dates=all_dates,month_range=month_range)
+                    if len(self.date_idxs) < n_keep:
+                        raise ValueError("Only {} training dates allowed for forecast #{}, fewer than {} analogs.".format(
+                                         len(self.date_idxs),nfcst,n_keep))
+                self._find_distances(train,forecasts[nfcst],n_vars,reuse=True,times=self._candidate_dates(),
+                                     rank_dates=None if full_climatology else self.date_idxs)
+                with self._stage('select'):
+                    idxs,dists = select_analogs(self.total_distances,*self._domain(),n_analogs=n_keep)
+                    self._regional(analog_idxs[nfcst])[...] = self._full_axis(idxs)
+                    self._regional(analog_dists[nfcst])[...] = dists
+            return analog_idxs,analog_dists
+
+
+    def _station_windows(self, station_lats, station_lons):
+        """
+        Snap stations to their nearest grid points and lay out the local domains of the distinct grid points.
+        :return lat_idxs/lon_idxs:
+            NumPy arrays, (n_stations,) grid indices of each station.
+        :return station_cells:
+            NumPy array, (n_stations,) which distinct grid point each station uses.
+        :return points:
+            tuple of NumPy arrays, (lat,lon) indices of every grid point some local domain touches, each read once.
+        :return windows:
+            scipy sparse matrix, (n_points,n_cells) how often each point is in each distinct grid point's local
+            domain, clamped to the edge of the grid like halo_box().
+        """
+        station_lats,station_lons = np.atleast_1d(station_lats),np.atleast_1d(station_lons)
+        if station_lats.shape != station_lons.shape or station_lats.ndim != 1:
+            raise ValueError("station_lats and station_lons have to be 1-d and the same length.")
+        n_lats,n_lons = self.all_lats.shape[0],self.all_lons.shape[0]
+        # --- One (grid,station) distance matrix per axis finds every station's nearest grid point at once
+        lat_idxs = find_nearest_idx(self.all_lats[:,np.newaxis],station_lats)
+        lon_idxs = find_nearest_idx(self.all_lons[:,np.newaxis],station_lons)
+        cells,station_cells = np.unique(lat_idxs*n_lons+lon_idxs,return_inverse=True)
+        g = self.grid_window
+        di,dj = np.meshgrid(np.arange(-g,g+1),np.arange(-g,g+1),indexing='ij')
+        ii = np.clip((cells//n_lons)[:,np.newaxis] + di.ravel(),0,n_lats-1)
+        jj = np.clip((cells % n_lons)[:,np.newaxis] + dj.ravel(),0,n_lons-1)
+        flat_points,window_pos = np.unique(ii*n_lons+jj,return_inverse=True)
+        windows = coo_matrix((np.ones(ii.size),(window_pos.ravel(),np.repeat(np.arange(cells.shape[0]),ii.shape[1]))),
+                             shape=(flat_points.shape[0],cells.shape[0])).tocsr()
+        return lat_idxs,lon_idxs,station_cells.ravel(),(flat_points//n_lons,flat_points % n_lons),windows
+
+
+    def _read_points(self, array, key, points):
+        """
+        array[key] at the scattered grid points, read as their bounding box so array-likes get one slab read.
+        :return values:
+            NumPy array, (...,n_points).
+        """
+        pi,pj = points
+        box = np.asarray(array[tuple(key)+(slice(pi.min(),pi.max()+1),slice(pj.min(),pj.max()+1))])
+        return box[...,pi-pi.min(),pj-pj.min()]
+
+
+    def find_station_analogs(self, train, forecast, station_lats, station_lons, n_analogs, dates=None,
+                             block_size=256, full_climatology=False):
+        """
+        Used to find analogs at a list of stations rather than over a domain. Each station is snapped to its nearest
+        grid point and local domains are compared only there, once per grid point however many stations share it,
+        reading the training data at the union of their (2*grid_window+1)^2 windows only. Rank climatologies of
+        those points are kept and reused while the same train array (and stations, candidate dates) are passed.
+        :param forecast/train:
+            NumPy arrays as for find_analogs, on the full lat_bounds/lon_bounds grid.
+        :param station_lats/station_lons:
+            lists or 1-d NumPy arrays of station latitudes/longitudes.
+        :param n_analogs:
+            integer number of analogs to keep per station, or if < 1 the fraction of training dates to keep.
+        :param dates:
+            NumPy array, optional candidate training dates (indices or boolean mask), see find_analogs.
+        :param block_size:
+            integer, number of training dates compared at once.
+        :param full_climatology:
+            boolean, if True the rank method ranks against every training date rather than the candidate dates.
+        :return station_idxs:
+            NumPy array, 2-d (n_analogs,n_stations) training date indices, best match first. Also kept in
+            self.station_indices, with the stations' grid indices in self.station_lat_idxs/self.station_lon_idxs.
+        :return station_dists:
+            NumPy array, 2-d (n_analogs,n_stations) distances of those analogs.
+        """
+        with self._profile_call('find_station_analogs',np.size(station_lats)):
+            train = self._open_train(train)
+            with self._stage('validate'):
+                n_vars = self._check_inputs(train,forecast)
+                n_all_dates = train.shape[0] if n_vars == 1 else train.shape[1]
+                date_idxs = self._date_selection(dates,n_all_dates)
+                lat_idxs,lon_idxs,station_cells,points,windows = self._station_windows(station_lats,station_lons)
+            times = np.arange(n_all_dates) if date_idxs is None else date_idxs
+            n_keep = n_analogs_from_frac(n_analogs,len(times))
+            methods = self.comp_method[:n_vars]
+            # --- Dates the rank method ranks within, and where the compared dates sit among them
+            rank_times = np.arange(n_all_dates) if date_idxs is None or full_climatology else date_idxs
+            rank_pos = np.searchsorted(rank_times,times)
+            weights = self._var_weights(n_vars,len(rank_times))
+            if self._station_train is not train:
+                self._station_train = train
+                self._station_clim = {}
+
+            n_pts = (2*self.grid_window+1)**2
+            total = np.zeros((len(times),windows.shape[1]),dtype=self.dtype)
+            for nvar,meth in enumerate(methods):
+                key = () if n_vars == 1 else (nvar,)
+                fvals = self._read_points(forecast,key,points)
+                values,ranks,fcst_ranks = None,None,None
                 if meth == 'rank':
-                    _rank_analog_grid(train[nvar,...],forecast[nvar,...],self.distances[nvar,...],self.start_lat_idx,self.stop_lat_idx,
-                                      self.start_lon_idx,self.stop_lon_idx, self.grid_window)
-                elif meth == 'rmse':
-                    _rmse_analog_grid(train[nvar,...],forecast[nvar,...],self.distances[nvar,...],self.start_lat_idx,self.stop_lat_idx,
-                                      self.start_lon_idx,self.stop_lon_idx, self.grid_window)
-                elif meth == 'mae':
-                    _mae_analog_grid(train[nvar,...],forecast[nvar,...],self.distances[nvar,...],self.start_lat_idx,self.stop_lat_idx,
-                                      self.start_lon_idx,self.stop_lon_idx, self.grid_window)
+                    # --- Ranks need the whole climatology at every point, everything else can stream
+                    with self._stage('rank'):
+                        clim_key = (nvar,points[0].tobytes(),points[1].tobytes(),
+                                    None if len(rank_times) == n_all_dates else rank_times.tobytes())
+                        if clim_key not in self._station_clim:
+                            if clim_key[-1] is not None:
+                                # --- Only the latest set of candidate dates is kept per variable
+                                for old_key in [k for k in self._station_clim if k[0] == nvar and k[-1] is not None]:
+                                    del self._station_clim[old_key]
+                            values = np.concatenate([self._read_points(train,key+(
+                                                         slice(t0,t0+block_size) if clim_key[-1] is None else
+                                                         rank_times[t0:t0+block_size],),points)
+                                                     for t0 in range(0,len(rank_times),block_size)])
+                            ranks,sorted_clim = rank_columns(values,return_sorted=True)
+                            self._station_clim[clim_key] = (values,compact_ranks(ranks),sorted_clim)
+                        values,ranks,sorted_clim = self._station_clim[clim_key]
+                        fcst_ranks = forecast_ranks(sorted_clim,fvals)
+                for t0 in range(0,len(times),block_size):
+                    block = slice(t0,min(t0+block_size,len(times)))
+                    with self._stage('read'):
+                        if values is None:
+                            block_vals = self._read_points(train,key+(times[block],),points)
+                        else:
+                            block_vals = values[rank_pos[block]]
+                    with self._stage('distances'):
+                        total[block] += weights[nvar]*station_distances(meth,block_vals,fvals,windows,n_pts,
+                                                                        None if ranks is None else ranks[rank_pos[block]],
+                                                                        fcst_ranks)
+            if self._profiler is not None:
+                self._profiler.count_dates(len(times))
 
-                # --- Now, we add weights to the distances...
-                self.distances[nvar,...] *= self.field_weights[nvar]
+            with self._stage('select'):
+                idxs,dists = select_analogs(total[:,:,np.newaxis],0,windows.shape[1]-1,0,0,n_keep)
+                idxs = times[idxs[:,station_cells,0]]
+            self.station_lat_idxs,self.station_lon_idxs = lat_idxs,lon_idxs
+            self.station_indices,self.station_distances = idxs,dists[:,station_cells,0]
+            self._station_n_dates = len(times)
+            return self.station_indices,self.station_distances
 
-            # --- sum up distances along variable axis
-            #self.total_distances = np.sum(self.distances,axis=0)
 
-        # --- now find indices of closest ranks
-        #self.indices = argsort_analogs(self.total_distances,self.start_lat_idx,self.stop_lat_idx,
-        #                              self.start_lon_idx,self.stop_lon_idx)
+    def gen_station_forecast(self, events, pct_samps, thresholds=None):
+        """
+        Function to generate probabilities at the stations from find_station_analogs: the fraction of the best
+        pct_samps analogs with an event at the station's grid point.
+        :param events:
+            NumPy array, 3-d (time,lat,lon) binary events on the training dates, a 4-d (n_events,time,lat,lon) stack
+            of them, or 3-d (time,lat,lon) observations if thresholds are given.
+        :param pct_samps:
+            number of analogs to use (at most the number kept), or if < 1 the fraction of training dates.
+        :param thresholds:
+            list of scalar thresholds, optional. events are then observations and the probability of exceeding each
+            threshold is returned.
+        :return proba:
+            NumPy array, 1-d (n_stations,) for a single events cube, otherwise 2-d (n_events,n_stations) or
+            (n_thresholds,n_stations).
+        """
+        with self._profile_call('gen_station_forecast',0 if self.station_indices is None else
+                                self.station_indices.shape[1]):
+            if self.station_indices is None:
+                raise ValueError("No station analogs found yet, run find_station_analogs first.")
+            n_use = n_analogs_from_frac(pct_samps,self._station_n_dates)
+            if n_use > self.station_indices.shape[0]:
+                raise ValueError("Asked for {} analogs but only {} were kept by find_station_analogs.".format(
+                                 n_use,self.station_indices.shape[0]))
+            with self._stage('select'):
+                values = events[...,self.station_indices[:n_use],self.station_lat_idxs,self.station_lon_idxs]
+            with self._stage('proba'):
+                if thresholds is not None:
+                    return np.stack([np.mean(values > thresh,axis=0) for thresh in thresholds])
+                return np.mean(values,axis=-2)
+
+
+    def _analog_sample(self,obs,pct_samps,interp):
+        """
+        Observations of the analogs over the forecast domain and their weights, shared by every threshold/quantile.
+        :return values:
+            NumPy array, 3-d (n_samples,lat,lon), the selected analogs' observations or, if interp, every
+            training date's.
+        :return weights:
+            NumPy array, 3-d (n_samples,lat,lon) interpolation weights, None for equally weighted analogs.
+        """
+        if interp:
+            if self.distances is None:
+                raise ValueError("interp=True needs the per-variable distances, use Analog(keep_var_distances=True) "
+                                 "and an exact, unblocked find_analogs.")
+            weights = interp_weights(self.distances,*self._domain(),pct_samps=pct_samps)
+            return self._crop(obs)[self._candidate_dates()],weights
+        pct_samps = self._n_candidates(pct_samps)
+        return analog_values(self._analog_indices(pct_samps),self._crop(obs),*self._domain(),n_analogs=pct_samps),None
 
-        return self
 
+    def _thresholds(self, thresholds):
+        """
+        Thresholds with any 2-d (lat,lon) ones cut down to the forecast domain.
+        """
+        return [self._crop(np.asarray(thresh)) if np.ndim(thresh) >= 2 else thresh for thresh in thresholds]
 
-    def gen_forecast(self,events,pct_samps,interp=False):
+
+    def _candidate_dates(self):
+        """
+        Index of the training dates self.distances covers, for lining events/observations up with them.
         """
-        Function to generate probabilities for forecasts...
+        return slice(None) if self.date_idxs is None else self.date_idxs
+
+
+    def _n_candidates(self, pct_samps):
+        """
+        With candidate dates, a fraction of training dates means a fraction of the candidates.
+        """
+        if self.date_idxs is not None and pct_samps < 1:
+            return n_analogs_from_frac(pct_samps,len(self.date_idxs))
+        return pct_samps
+
+
+    def _analog_indices(self,pct_samps):
+        """
+        Compact (k,lat,lon) analog indices over the forecast domain, taken from find_analogs(n_analogs=...) if it
+        kept them, otherwise the pct_samps closest dates are selected from the full distances.
+        """
+        if self.n_analogs is not None:
+            return self._regional(self.indices)
+        if self.total_distances is None:
+            raise ValueError("No analogs found yet, run find_analogs first.")
+        return self._full_axis(select_analogs(self.total_distances,*self._domain(),n_analogs=pct_samps)[0])
+
+
+    def gen_forecast(self,events,pct_samps,interp=False,thresholds=None):
+        """
+        Function to generate probabilities for forecasts. Every event/threshold shares the same analog selection
+        (or interpolation weights).
 
         :param events:
+            NumPy array, 3-d (time,lat,lon) binary events on the training dates, a 4-d (n_events,time,lat,lon)
+            stack of them, or 3-d (time,lat,lon) observations if thresholds are given. lat/lon either span the full
+            grid or just the forecast domain.
+        :param pct_samps:
+            number of analogs to use, or if < 1 the fraction of training dates.
         :param interp:
+            boolean, if True weight the training dates by their scaled distance (see interp_weights()).
+        :param thresholds:
+            list of thresholds, optional. events are then observations and the probability of exceeding each
+            threshold is returned.
         :return proba:
+            NumPy array, 2-d (lat,lon) for a single events cube, otherwise 3-d (n_events,lat,lon) or
+            (n_thresholds,lat,lon).
         """
+        with self._profile_call('gen_forecast'):
+            if thresholds is not None:
+                with self._stage('select'):
+                    values,weights = self._analog_sample(events,pct_samps,interp)
+                with self._stage('proba'):
+                    return self._output(threshold_proba(values,self._thresholds(thresholds),weights))
+            if interp and self.distances is None:
+                raise ValueError("interp=True needs the per-variable distances, use Analog(keep_var_distances=True) "
+                                 "and an exact, unblocked find_analogs.")
+            # --- interp_proba handles a single variable's 3-d distances as well as the per-variable 4-d array
+            if interp:
+                with self._stage('proba'):
+                    probs = interp_proba(self.distances,self._crop(events)[...,self._candidate_dates(),:,:],
+                                         *self._domain(),pct_samps=pct_samps)
+            else:
+                pct_samps = self._n_candidates(pct_samps)
+                with self._stage('select'):
+                    analog_idxs = self._analog_indices(pct_samps)
+                with self._stage('proba'):
+                    probs = gen_proba_topk(analog_idxs,self._crop(events),*self._domain(),n_analogs=pct_samps)
+            return self._output(probs)
 
-        if interp:
-            probs = interp_proba(self.distances,events,self.start_lat_idx,self.stop_lat_idx,self.start_lon_idx,self.stop_lon_idx,pct_samps)
-        if not interp:
-            probs = gen_proba(self.indices,events,self.start_lat_idx,self.stop_lat_idx,self.start_lon_idx,self.stop_lon_idx,pct_samps)
-        return probs
+
+    def gen_cdf(self,obs,pct_samps,thresholds,interp=False):
+        """
+        Function to generate the analog CDF, P(obs <= threshold), at a list of thresholds.
+        :param obs:
+            NumPy array, 3-d (time,lat,lon) observations on the training dates.
+        :param thresholds:
+            list of thresholds, scalars or 2-d (lat,lon) arrays.
+        :return cdf:
+            NumPy array, 3-d (n_thresholds,lat,lon).
+        """
+        with self._profile_call('gen_cdf'):
+            with self._stage('select'):
+                values,weights = self._analog_sample(obs,pct_samps,interp)
+            with self._stage('proba'):
+                return self._output(threshold_proba(values,self._thresholds(thresholds),weights,below=True))
+
+
+    def gen_quantiles(self,obs,pct_samps,quantiles,interp=False):
+        """
+        Function to generate quantiles of the analogs' observations.
+        :param obs:
+            NumPy array, 3-d (time,lat,lon) observations on the training dates.
+        :param quantiles:
+            list of quantiles, between 0 and 1.
+        :return quants:
+            NumPy array, 3-d (n_quantiles,lat,lon). NaN outside the forecast domain.
+        """
+        with self._profile_call('gen_quantiles'):
+            with self._stage('select'):
+                values,weights = self._analog_sample(obs,pct_samps,interp)
+            with self._stage('quantiles'):
+                return self._output(weighted_quantiles(values,weights,quantiles),fill=np.nan)
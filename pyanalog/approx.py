@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+
+import numpy as np
+from scipy.spatial import cKDTree
+from .comp_funcs import forecast_ranks,expand_ranks,n_analogs_from_frac
+
+
+class PatchSearch(object):
+    """Approximate analog search: local patches are projected onto a small EOF (PCA) basis fitted on the training
+    archive, candidates come from a KD-tree per grid point, then get re-ranked exactly with comp_method."""
+
+    def __init__(self, analog, n_components=6, max_samples=10000, seed=0):
+        """
+        :param analog:
+            Analog object, sets grid_window, the forecast domain, comp_method and field_weights.
+        :param n_components:
+            integer, number of EOFs each (2*grid_window+1)^2 * n_vars patch is reduced to. Each grid point keeps
+            n_components floats per training date for its KD-tree.
+        :param max_samples:
+            integer, number of random training patches used to fit the EOFs.
+        :param seed:
+            integer, seed for picking those patches.
+        """
+        self.analog = analog
+        self.n_components = n_components
+        self.max_samples = max_samples
+        self.seed = seed
+        self.trees = None
+        g = analog.grid_window
+        di,dj = np.meshgrid(np.arange(-g,g+1),np.arange(-g,g+1),indexing='ij')
+        self.di = di.ravel()
+        self.dj = dj.ravel()
+
+
+    def __repr__(self):
+        return "<PatchSearch(n_components={}, max_samples={}, fitted={})>".format(
+                        self.n_components, self.max_samples, self.trees is not None)
+
+
+    def _boxes(self, train, n_vars, times=slice(None)):
+        """
+        Training data for the forecast domain plus grid_window halo, one 3-d (time,lat,lon) array per variable.
+        :param times:
+            slice or sorted integer array, optional training dates to read.
+        """
+        if n_vars == 1:
+            return [self.analog._halo(train,(times,))]
+        return [self.analog._halo(train,(nvar,times)) for nvar in range(n_vars)]
+
+
+    def _features(self, values, nvar, meth, ranks=None):
+        """
+        Patch features for one variable, scaled so Euclidean distance between patches is roughly the weighted
+        comp_method distance: ranks * sqrt(n_pts) for rank (a sum of absolute differences), values / sqrt(n_pts)
+        for rmse/mae (a root mean square or mean). corr divides by sqrt(2*n_pts) times the variable's typical local
+        anomaly (self.scales); once each patch is centred (see fit()) the squared distance is then roughly
+        1 - correlation for patches of similar variance.
+        """
+        n_pts = float(self.di.shape[0])
+        if meth == 'rank':
+            feats = expand_ranks(ranks)*np.sqrt(n_pts)
+        elif meth == 'corr':
+            feats = values*self.scales[nvar]
+        else:
+            feats = values/np.sqrt(n_pts)
+        return feats*self.weights[nvar]
+
+
+    def _embed(self, feats, n_lats, n_lons):
+        """
+        Project every local patch onto the EOFs.
+        :param feats:
+            list of 3-d (time,lat,lon) feature arrays covering the domain plus halo, one per variable.
+        :return emb:
+            NumPy array, 4-d (n_components,time,lat,lon) embeddings of the forecast domain.
+        """
+        g = self.analog.grid_window
+        n_pts = self.di.shape[0]
+        emb = np.zeros((self.components.shape[1],feats[0].shape[0],n_lats,n_lons))
+        # --- Each EOF is a (2*grid_window+1)^2 stencil, so apply it offset by offset over the whole domain
+        for v,feat in enumerate(feats):
+            for p in range(n_pts):
+                shifted = feat[:,g+self.di[p]:g+self.di[p]+n_lats,g+self.dj[p]:g+self.dj[p]+n_lons]
+                for k in range(emb.shape[0]):
+                    emb[k] += self.components[v*n_pts+p,k]*shifted
+        emb -= self.offset[:,np.newaxis,np.newaxis,np.newaxis]
+        return emb
+
+
+    def fit(self, train, n_vars):
+        """
+        Fit the EOF basis on random training patches and build one KD-tree per forecast grid point.
+        :param train:
+            NumPy array (or memory-mapped array), 3-d (time,lat,lon) or 4-d (n_vars,time,lat,lon) training data.
+        :param n_vars:
+            integer, number of variables.
+        :return self:
+        """
+        an = self.analog
+        g = an.grid_window
+        n_lats = an.stop_lat_idx - an.start_lat_idx + 1
+        n_lons = an.stop_lon_idx - an.start_lon_idx + 1
+        boxes = self._boxes(train,n_vars)
+        self.n_dates = boxes[0].shape[0]
+        self.methods = an.comp_method[:n_vars]
+        # --- Same weights (defaults, rank normalisation) as the exact distances, which the re-rank reproduces
+        self.weights = an._var_weights(n_vars,self.n_dates)
+        n_pts = self.di.shape[0]
+
+        # --- Random sample of local patches to fit the EOFs on
+        rng = np.random.RandomState(self.seed)
+        n_samples = min(self.max_samples,self.n_dates*n_lats*n_lons)
+        t = rng.randint(0,self.n_dates,n_samples)[:,np.newaxis]
+        i = g + rng.randint(0,n_lats,n_samples)[:,np.newaxis] + self.di
+        j = g + rng.randint(0,n_lons,n_samples)[:,np.newaxis] + self.dj
+        self.scales = [1.]*n_vars
+        for v,(box,meth) in enumerate(zip(boxes,self.methods)):
+            if meth == 'corr':
+                anoms = box[t,i,j] - box[t,i,j].mean(axis=1,keepdims=True)
+                sigma = np.sqrt(np.mean(anoms**2))
+                self.scales[v] = 1./(sigma*np.sqrt(2.*n_pts)) if sigma > 0 else 1.
+        feats = []
+        for v,(box,meth) in enumerate(zip(boxes,self.methods)):
+            ranks = an._rank_climatology(train,None if n_vars == 1 else v)[0] if meth == 'rank' else None
+            feats.append(self._features(box,v,meth,ranks))
+
+        patches = np.concatenate([feat[t,i,j] for feat in feats],axis=1)
+        # --- Correlation ignores each patch's mean, so centre corr patches and keep the EOFs free of the mean too:
+        # --- projecting a raw patch then gives the same as projecting the centred one
+        corr_blocks = [slice(v*n_pts,(v+1)*n_pts) for v,meth in enumerate(self.methods) if meth == 'corr']
+        for block in corr_blocks:
+            patches[:,block] -= patches[:,block].mean(axis=1,keepdims=True)
+        mean_patch = patches.mean(axis=0)
+        vt = np.linalg.svd(patches - mean_patch,full_matrices=False)[2]
+        self.components = vt[:self.n_components].T
+        for block in corr_blocks:
+            self.components[block] -= self.components[block].mean(axis=0)
+        self.offset = np.dot(mean_patch,self.components)
+
+        emb = self._embed(feats,n_lats,n_lons)
+        self.trees = [[cKDTree(emb[:,:,i,j].T) for j in range(n_lons)] for i in range(n_lats)]
+        return self
+
+
+    def query(self, train, forecast, n_vars, n_analogs, n_candidates=None):
+        """
+        Find approximate analogs for one forecast. The n_candidates nearest dates in EOF space are re-ranked
+        with the exact comp_method distances, so the returned distances are exact.
+        :param forecast:
+            NumPy array, 2-d (lat,lon) or 3-d (n_vars,lat,lon) forecast.
+        :param n_analogs:
+            integer number of analogs to keep, or if < 1 the fraction of training dates to keep.
+        :param n_candidates:
+            integer, number of candidates per grid point to re-rank. Defaults to 4*n_analogs.
+        :return analog_idxs:
+            NumPy array, 3-d (n_analogs,lat,lon) training date indices over the forecast domain, best match first.
+        :return analog_dists:
+            NumPy array, 3-d (n_analogs,lat,lon) exact distances over the forecast domain.
+        """
+        if self.trees is None:
+            raise ValueError("PatchSearch has to be fit() before it can be queried.")
+        an = self.analog
+        g = an.grid_window
+        n_lats = an.stop_lat_idx - an.start_lat_idx + 1
+        n_lons = an.stop_lon_idx - an.start_lon_idx + 1
+        n_keep = n_analogs_from_frac(n_analogs,self.n_dates)
+        n_cand = min(self.n_dates,max(n_candidates or 4*n_keep,n_keep))
+
+        fboxes = [an._halo(forecast,() if n_vars == 1 else (v,)).astype(np.float64) for v in range(n_vars)]
+        ranks,franks = [None]*n_vars,[None]*n_vars
+        for v,meth in enumerate(self.methods):
+            if meth == 'rank':
+                ranks[v],sorted_clim = an._rank_climatology(train,None if n_vars == 1 else v)
+                franks[v] = forecast_ranks(sorted_clim,fboxes[v])
+        feats = [self._features(fboxes[v][np.newaxis],v,meth,None if franks[v] is None else franks[v][np.newaxis])
+                 for v,meth in enumerate(self.methods)]
+        emb = self._embed(feats,n_lats,n_lons)[:,0]
+
+        cands = np.empty((n_cand,n_lats,n_lons),dtype=np.intp)
+        for i in range(n_lats):
+            for j in range(n_lons):
+                cands[:,i,j] = np.atleast_1d(self.trees[i][j].query(emb[:,i,j],k=n_cand)[1])
+
+        # --- Only the candidate dates are read for the re-rank, not the whole archive
+        cand_times = np.unique(cands)
+        boxes = self._boxes(train,n_vars,cand_times)
+        cand_pos = np.searchsorted(cand_times,cands)
+
+        # --- Exact re-rank, one row of the domain at a time to bound the gathered patches
+        analog_idxs = np.empty((n_keep,n_lats,n_lons),dtype=np.intp)
+        analog_dists = np.empty((n_keep,n_lats,n_lons))
+        jj = g + np.arange(n_lons)[:,np.newaxis] + self.dj
+        for i in range(n_lats):
+            ii = g + i + self.di
+            row_cands = cands[:,i,:,np.newaxis]
+            total = np.zeros((n_cand,n_lons))
+            for v,meth in enumerate(self.methods):
+                vals = boxes[v][cand_pos[:,i,:,np.newaxis],ii,jj]
+                fvals = fboxes[v][ii,jj]
+                if meth == 'rank':
+                    adj = expand_ranks(ranks[v][row_cands,ii,jj]) + (vals > fvals) + 0.5*(vals == fvals)
+                    dist = np.sum(np.absolute(adj - franks[v][ii,jj]),axis=-1)
+                elif meth == 'rmse':
+                    dist = np.sqrt(np.mean((vals - fvals)**2,axis=-1))
+                elif meth == 'mae':
+                    dist = np.mean(np.absolute(vals - fvals),axis=-1)
+                elif meth == 'corr':
+                    anoms = vals - vals.mean(axis=-1,keepdims=True)
+                    fanoms = fvals - fvals.mean(axis=-1,keepdims=True)
+                    with np.errstate(divide='ignore',invalid='ignore'):
+                        corr = np.sum(anoms*fanoms,axis=-1)/np.sqrt(np.sum(anoms**2,axis=-1)*np.sum(fanoms**2,axis=-1))
+                    corr[~np.isfinite(corr)] = 0.
+                    dist = 1. - np.clip(corr,-1.,1.)
+                else:
+                    dist = np.zeros(total.shape)
+                total += self.weights[v]*dist
+            order = np.lexsort((cands[:,i,:],total),axis=0)[:n_keep]
+            cols = np.arange(n_lons)
+            analog_idxs[:,i] = cands[order,i,cols]
+            analog_dists[:,i] = total[order,cols]
+        return analog_idxs,analog_dists
@@ -1,136 +1,640 @@
 #!/usr/bin/env python
 
 import numpy as np
-from scipy.stats import rankdata as rd
-from numba import autojit
-from scipy.interpolate import Rbf
 
-@autojit
-def _rank_analog_grid(train,forecast,out_array,i_start,i_stop,j_start,j_stop, grid_window):
+def rank_columns(array, return_sorted=False):
     """
-    Function to find analogous dates based on root mean square error.
+    Function to rank every grid point's values along the time (first) axis in one batched pass.
+    Ties get their average rank, same as scipy.stats.rankdata(array[:,i,j],method='average').
     :param array:
-        Some 2-d numpy array
-    :return self:
+        NumPy array, n-d (time,...) array.
+    :param return_sorted:
+        boolean, if True also return the values sorted along the time axis (the sorted climatology).
+    :return ranks:
+        NumPy array, float ranks (1 to time) with the same shape as array.
     """
+    n_times = array.shape[0]
+    values = array.reshape(n_times,-1)
+    cols = np.arange(values.shape[1])[np.newaxis,:]
+    order = np.argsort(values,axis=0,kind='mergesort')
+    sorted_vals = values[order,cols]
+    # --- Mark where each run of tied values starts/stops, then spread the first/last position over the run
+    pos = np.arange(n_times)[:,np.newaxis]
+    new_run = np.ones(sorted_vals.shape,dtype=bool)
+    new_run[1:] = sorted_vals[1:] != sorted_vals[:-1]
+    end_run = np.ones(sorted_vals.shape,dtype=bool)
+    end_run[:-1] = new_run[1:]
+    first = np.maximum.accumulate(np.where(new_run,pos,0),axis=0)
+    last = np.minimum.accumulate(np.where(end_run,pos,n_times-1)[::-1],axis=0)[::-1]
+    ranks = np.empty(values.shape)
+    ranks[order,cols] = (first + last)/2. + 1.
+    if return_sorted:
+        return ranks.reshape(array.shape),sorted_vals.reshape(array.shape)
+    return ranks.reshape(array.shape)
 
-    shp1 = (train.shape[0],(((grid_window*2)+1)*((grid_window*2)+1)))
-    shp2 = (1,(((grid_window*2)+1)*((grid_window*2)+1)))
-    ranked_array = np.empty((train.shape[0]+1,forecast.shape[0],forecast.shape[1]))
-    # --- Fill in ranked array
-    ranked_array[:-1,...] = train
-    ranked_array[-1,...] = forecast
-    # --- First, rank data at each array in relevant domain
-    for i in range(i_start-grid_window,i_stop+grid_window+1,1): # --- latitudes
-        for j in range(j_start-grid_window,j_stop+grid_window+1,1): # --- longitudes
-            ranked_array[:,i,j] = rd(ranked_array[:,i,j],method='average')
-    # --- Now find differences at each forecast grid point and local-domain
-    for i in range(i_start,i_stop+1,1): # --- latitudes
-        for j in range(j_start,j_stop+1,1): # --- longitudes
-            out_array[:,i,j] = (np.sum(np.absolute(ranked_array[:-1,i-grid_window:i+grid_window+1,j-grid_window:j+grid_window+1].reshape(shp1)
-                                      -ranked_array[-1,i-grid_window:i+grid_window+1,j-grid_window:j+grid_window+1].reshape(shp2)),
-                                      axis=1))
-    return out_array
+
+def compact_ranks(ranks):
+    """
+    Function to store average ranks compactly: doubled (so ties ending in .5 stay whole numbers) in the smallest
+    unsigned integer type that holds them, uint16 for up to 32767 dates and uint32 beyond that.
+    :param ranks:
+        NumPy array, float ranks from rank_columns().
+    :return ranks:
+        NumPy array, 2*ranks as uint16/uint32. The rank kernel halves them again.
+    """
+    return (2*ranks).astype(_compact_dtype(ranks.shape[0]))
 
 
-@autojit
-def _rmse_analog_grid(train,forecast,out_array,i_start,i_stop,j_start,j_stop, grid_window):
+def _compact_dtype(n_dates):
+    return np.uint16 if 2*n_dates <= np.iinfo(np.uint16).max else np.uint32
+
+
+def expand_ranks(ranks):
     """
-    Function to find analogous dates based on root mean square error.
+    Function to turn ranks from compact_ranks() back into float ranks. Float ranks are returned as they are.
+    """
+    if ranks.dtype.kind in 'ui':
+        return ranks/2.
+    return ranks
+
+
+def _search_columns(sorted_clim, values, side='left'):
+    """
+    Function to binary search every column of a sorted climatology at once, like np.searchsorted per column.
+    :param sorted_clim:
+        NumPy array, n-d (time,...) array sorted along the time axis.
+    :param values:
+        NumPy array, (...) array of values to look up, one per column.
+    :return positions:
+        NumPy array, integer insertion positions with the same shape as values.
+    """
+    n_times = sorted_clim.shape[0]
+    clim = sorted_clim.reshape(n_times,-1)
+    vals = np.asarray(values).reshape(-1)
+    cols = np.arange(clim.shape[1])
+    lo = np.zeros(clim.shape[1],dtype=np.intp)
+    hi = np.full(clim.shape[1],n_times,dtype=np.intp)
+    for _ in range(int(np.ceil(np.log2(n_times+1)))):
+        mid = (lo + hi)//2
+        probe = clim[np.minimum(mid,n_times-1),cols]
+        go_right = (probe < vals) if side == 'left' else (probe <= vals)
+        go_right &= lo < hi
+        lo = np.where(go_right,mid+1,lo)
+        hi = np.where(go_right | (lo >= hi),hi,mid)
+    return lo.reshape(np.shape(values))
+
+
+def forecast_ranks(sorted_clim, forecast):
+    """
+    Function to find the (average) rank each forecast value would get if added to the training climatology.
+    :param sorted_clim:
+        NumPy array, 3-d (time,lat,lon) training values sorted along time, from rank_columns(...,return_sorted=True).
+    :param forecast:
+        NumPy array, 2-d (lat,lon) forecast over the same grid points.
+    :return fcst_ranks:
+        NumPy array, 2-d (lat,lon) float ranks, 1 to time+1.
+    """
+    n_below = _search_columns(sorted_clim,forecast,side='left')
+    n_ties = _search_columns(sorted_clim,forecast,side='right') - n_below
+    return n_below + 1. + n_ties/2.
+
+
+def update_rank_climatology(train_box, train_ranks, sorted_clim, added, n_evict=0):
+    """
+    Function to update a ranked training climatology for new training dates, optionally dropping the oldest ones,
+    without ranking the whole archive again. Every kept value is compared against the added/evicted values only,
+    so the cost grows with (n_added + n_evict) * time rather than time * log(time).
+    :param train_box:
+        NumPy array, 3-d (time,lat,lon) training values the climatology was built from.
+    :param train_ranks:
+        NumPy array, 3-d (time,lat,lon) ranks of train_box, from rank_columns() or compact_ranks().
+    :param sorted_clim:
+        NumPy array, 3-d (time,lat,lon) train_box sorted along time.
+    :param added:
+        NumPy array, 3-d (n_added,lat,lon) values on the new training dates, appended after the kept dates.
+    :param n_evict:
+        integer, number of oldest training dates to drop.
+    :return train_ranks:
+        NumPy array, 3-d (time-n_evict+n_added,lat,lon) compact ranks, same as compact_ranks(rank_columns(...)) of
+        the updated archive.
+    :return sorted_clim:
+        NumPy array, 3-d (time-n_evict+n_added,lat,lon) updated sorted climatology.
+    """
+    n_times = train_box.shape[0]
+    kept = train_box[n_evict:]
+    evicted = train_box[:n_evict]
+    # --- Work with doubled ranks, so ties ending in .5 stay whole numbers
+    if train_ranks.dtype.kind in 'ui':
+        ranks = train_ranks[n_evict:].astype(np.int64)
+    else:
+        ranks = (2*train_ranks[n_evict:]).astype(np.int64)
+    # --- A kept value moves down a rank for every dropped value below it (half for a tie), up for every added one
+    for old in evicted:
+        ranks -= 2*(old < kept) + (old == kept)
+    for new in added:
+        ranks += 2*(new < kept) + (new == kept)
+
+    # --- Take the evicted values out of the sorted climatology, one slot per value even when they tie
+    clim = sorted_clim.reshape(n_times,-1)
+    cols = np.arange(clim.shape[1])
+    if n_evict:
+        old_sorted = np.sort(evicted.reshape(n_evict,-1),axis=0)
+        drop = np.zeros(clim.shape,dtype=bool)
+        n_dup = np.zeros(clim.shape[1],dtype=np.intp)
+        for k in range(n_evict):
+            if k:
+                n_dup = np.where(old_sorted[k] == old_sorted[k-1],n_dup+1,0)
+            drop[_search_columns(clim,old_sorted[k])+n_dup,cols] = True
+        clim = clim.T[~drop.T].reshape(clim.shape[1],n_times-n_evict).T
+    # --- Two sorted runs, which the stable sort merges in linear time. With nothing added (evicting only) the
+    # --- climatology is already sorted
+    new_vals = added.reshape(added.shape[0],int(np.prod(train_box.shape[1:])))
+    if new_vals.shape[0]:
+        clim = np.sort(np.concatenate((clim,np.sort(new_vals,axis=0))),axis=0,kind='stable')
+
+    # --- Doubled average rank of an added value is n_below + n_below_or_tied + 1 in the updated climatology
+    new_ranks = np.empty(new_vals.shape,dtype=np.int64)
+    for k in range(new_vals.shape[0]):
+        new_ranks[k] = _search_columns(clim,new_vals[k],side='left') + _search_columns(clim,new_vals[k],side='right') + 1
+    n_dates = clim.shape[0]
+    ranks = np.concatenate((ranks,new_ranks.reshape(added.shape)))
+    return ranks.astype(_compact_dtype(n_dates)),clim.reshape((n_dates,)+train_box.shape[1:])
+
+
+def halo_box(array, key, i_start, i_stop, j_start, j_stop, grid_window):
+    """
+    Function to read the rows i_start..i_stop and columns j_start..j_stop of array, plus grid_window on every side.
+    Window points off the edge of the grid are clamped to the nearest edge row/column (edge padding), so local
+    domains at the grid boundary are complete rather than wrapping around or coming up short. Only the part of the
+    box on the grid is read, so array can be memory-mapped or chunked.
     :param array:
-        Some 2-d numpy array
-    :return self:
+        NumPy array (or array-like), with lat/lon as its last two axes.
+    :param key:
+        tuple, index into the leading axes of array, e.g. (nvar,times).
+    :return box:
+        NumPy array, [...,i_stop-i_start+2*grid_window+1,j_stop-j_start+2*grid_window+1].
+    """
+    g = grid_window
+    n_lats,n_lons = array.shape[-2:]
+    i0,i1 = max(i_start-g,0),min(i_stop+g+1,n_lats)
+    j0,j1 = max(j_start-g,0),min(j_stop+g+1,n_lons)
+    box = np.asarray(array[tuple(key)+(slice(i0,i1),slice(j0,j1))])
+    pad = ((i0-i_start+g,i_stop+g+1-i1),(j0-j_start+g,j_stop+g+1-j1))
+    if any(pad[0]) or any(pad[1]):
+        box = np.pad(box,((0,0),)*(box.ndim-2)+pad,mode='edge')
+    return box
+
+
+def _rank_analog_grid(train,forecast,out_array,i_start,i_stop,j_start,j_stop, grid_window, train_ranks=None,
+                      fcst_ranks=None):
+    """
+    Function to find analogous dates based on the summed absolute difference in ranks, where each grid point
+    is ranked over all training dates plus the forecast.
+    :param train_ranks:
+        NumPy array, optional output of rank_columns() (or compact_ranks()) on train over the forecast domain plus
+        grid_window halo. Pass it in to reuse the training climatology between forecasts.
+    :param fcst_ranks:
+        NumPy array, optional output of forecast_ranks() over the forecast domain plus grid_window halo. Needed
+        when train (and train_ranks) is only a block of the training dates the climatology was built from.
+    :return out_array:
     """
-    shp1 = (train.shape[0],(((grid_window*2)+1)*((grid_window*2)+1)))
-    shp2 = ((((grid_window*2)+1)*((grid_window*2)+1)))
-    # --- Now find differences at each forecast grid point and local-domain
-    for i in range(i_start,i_stop+1,1): # --- latitudes
-        for j in range(j_start,j_stop+1,1): # --- longitudes
-            out_array[:,i,j] = (np.sqrt(np.mean((train[:,i-grid_window:i+grid_window+1,j-grid_window:j+grid_window+1].reshape(shp1)
-                                      -forecast[i-grid_window:i+grid_window+1,j-grid_window:j+grid_window+1].reshape(shp2))**2,
-                                      axis=1,dtype=np.float)))
+    lats = slice(i_start-grid_window,i_stop+grid_window+1)
+    lons = slice(j_start-grid_window,j_stop+grid_window+1)
+    train_box = train[:,lats,lons]
+    fcst_box = forecast[lats,lons]
+    dtype = out_array.dtype
+    if train_ranks is None:
+        train_ranks = rank_columns(train_box)
+    # --- Merge the forecast into the ranked climatology: a training value moves up one rank if the forecast is
+    # --- smaller, half a rank if they tie (the tied run grows by one), and stays put otherwise.
+    above = train_box > fcst_box
+    ties = train_box == fcst_box
+    if fcst_ranks is None:
+        n_above = above.sum(axis=0)
+        n_ties = ties.sum(axis=0)
+        fcst_ranks = (train_box.shape[0] - n_above - n_ties) + 1. + n_ties/2.
+    # --- Ranks are whole or half numbers, so this is exact in float32 too
+    rank_diffs = train_ranks.astype(dtype)
+    if train_ranks.dtype.kind in 'ui':
+        rank_diffs /= 2
+    rank_diffs += above
+    rank_diffs += ties*dtype.type(0.5)
+    rank_diffs -= np.asarray(fcst_ranks,dtype=dtype)
+    np.absolute(rank_diffs,out=rank_diffs)
+    out_array[:,i_start:i_stop+1,j_start:j_stop+1] = _window_sum(rank_diffs,grid_window)
     return out_array
 
-@autojit
-def _mae_analog_grid(train,forecast,out_array,i_start,i_stop,j_start,j_stop, grid_window):
+
+def _window_sum(cells, grid_window, block_size=64):
+    """
+    Function to sum a field over the local domain around every grid point via a 2-d cumulative sum
+    (summed-area table), so the cost per grid point stays flat as grid_window grows.
+    :param cells:
+        NumPy array, 3-d (time,lat,lon) array of per-grid-point values, padded by grid_window points on every side.
+    :param grid_window:
+        integer, +/- number of grid points (n/s, e/w) in the local domain.
+    :param block_size:
+        integer, number of dates summed at once. The cumulative sums are kept in float64 whatever the input type,
+        this bounds that scratch array.
+    :return window_sums:
+        NumPy array, 3-d (time,lat-2*grid_window,lon-2*grid_window) array of local-domain sums, same float type
+        as cells (float64 for integer cells).
+    """
+    width = (grid_window*2)+1
+    dtype = cells.dtype if cells.dtype.kind == 'f' else np.float64
+    sums = np.empty((cells.shape[0],cells.shape[1]-width+1,cells.shape[2]-width+1),dtype=dtype)
+    sat = np.zeros((min(block_size,cells.shape[0]),cells.shape[1]+1,cells.shape[2]+1))
+    for t0 in range(0,cells.shape[0],block_size):
+        t1 = min(t0+block_size,cells.shape[0])
+        block = sat[:t1-t0]
+        np.cumsum(cells[t0:t1],axis=1,out=block[:,1:,1:])
+        np.cumsum(block[:,1:,1:],axis=2,out=block[:,1:,1:])
+        sums[t0:t1] = block[:,width:,width:] - block[:,:-width,width:] - block[:,width:,:-width] + block[:,:-width,:-width]
+    return sums
+
+
+def _rmse_analog_grid(train,forecast,out_array,i_start,i_stop,j_start,j_stop, grid_window, train_sumsq=None):
     """
     Function to find analogous dates based on root mean square error.
-    :param array:
-        Some 2-d numpy array
+    :param train_sumsq:
+        NumPy array, optional 3-d (time,i_stop-i_start+1,j_stop-j_start+1) sums of train**2 over each local domain
+        (from an AnalogIndex). If given, only the forecast-dependent cross term is summed here.
     :return self:
     """
-    shp1 = (train.shape[0],(((grid_window*2)+1)*((grid_window*2)+1)))
-    shp2 = ((((grid_window*2)+1)*((grid_window*2)+1)))
-    # --- Now find differences at each forecast grid point and local-domain
-    for i in range(i_start,i_stop+1,1): # --- latitudes
-        for j in range(j_start,j_stop+1,1): # --- longitudes
-            out_array[:,i,j] = (np.mean(np.abs(train[:,i-grid_window:i+grid_window+1,j-grid_window:j+grid_window+1].reshape(shp1)
-                                      -forecast[i-grid_window:i+grid_window+1,j-grid_window:j+grid_window+1].reshape(shp2)),
-                                      axis=1))
+    n_pts = ((grid_window*2)+1)*((grid_window*2)+1)
+    lats = slice(i_start-grid_window,i_stop+grid_window+1)
+    lons = slice(j_start-grid_window,j_stop+grid_window+1)
+    # --- Work in the output type, integer (packed) archives are cast here
+    dtype = out_array.dtype
+    if train_sumsq is not None:
+        # --- sum((t-f)**2) = sum(t**2) - 2*sum(t*f) + sum(f**2). The terms nearly cancel for fields far from zero
+        # --- (e.g. pressure), so they're all kept in float64 whatever dtype is, only the result is cast
+        fcst_box = np.asarray(forecast[np.newaxis,lats,lons],dtype=np.float64)
+        cross = _window_sum(np.asarray(train[:,lats,lons],dtype=np.float64)*fcst_box,grid_window)
+        sums = train_sumsq - 2.*cross + _window_sum(fcst_box**2,grid_window)
+    else:
+        fcst_box = forecast[np.newaxis,lats,lons].astype(dtype)
+        # --- Squared differences are found once per grid point, then summed over each local domain
+        sq_diffs = np.asarray(train[:,lats,lons],dtype=dtype) - fcst_box
+        sq_diffs *= sq_diffs
+        sums = _window_sum(sq_diffs,grid_window)
+    # --- Cancellation in the cumulative sums can leave tiny negative values, clip before sqrt
+    out_array[:,i_start:i_stop+1,j_start:j_stop+1] = np.sqrt(np.maximum(sums,0.)/n_pts)
     return out_array
 
-@autojit
-def argsort_analogs(analog_array,i_start,i_stop,j_start,j_stop):
+
+def _corr_analog_grid(train,forecast,out_array,i_start,i_stop,j_start,j_stop, grid_window, train_sum=None,
+                      train_sumsq=None):
     """
-    Function to find analogous dates based on root mean square error.
+    Function to find analogous dates based on the pattern (anomaly) correlation between the training and forecast
+    local domains, as 1 - correlation so smaller is better (0 to 2). Windowed sums of x, y, xy, x**2 and y**2 give
+    each grid point's correlation in constant time per training date, whatever the size of grid_window.
+    A local domain with no variance has no pattern to match and gets a distance of 1.
+    :param train_sum/train_sumsq:
+        NumPy arrays, optional 3-d (time,i_stop-i_start+1,j_stop-j_start+1) sums of train/train**2 over each local
+        domain (from an AnalogIndex). If given, only the forecast-dependent sums are found here.
+    :return out_array:
+    """
+    n_pts = ((grid_window*2)+1)*((grid_window*2)+1)
+    lats = slice(i_start-grid_window,i_stop+grid_window+1)
+    lons = slice(j_start-grid_window,j_stop+grid_window+1)
+    # --- The sums are differenced against each other, so always work in float64
+    train_box = np.asarray(train[:,lats,lons],dtype=np.float64)
+    fcst_box = np.asarray(forecast[lats,lons],dtype=np.float64)[np.newaxis]
+    if train_sum is None or train_sumsq is None:
+        # --- Correlation doesn't change when both fields are shifted by the same amount, so centre them on the
+        # --- forecast mean to keep the sums (and their cancellation error) small
+        shift = fcst_box.mean()
+        train_box = train_box - shift
+        fcst_box = fcst_box - shift
+        sum_x = _window_sum(train_box,grid_window)
+        sum_xx = _window_sum(train_box**2,grid_window)
+    else:
+        sum_x = np.asarray(train_sum,dtype=np.float64)
+        sum_xx = np.asarray(train_sumsq,dtype=np.float64)
+    sum_y = _window_sum(fcst_box,grid_window)
+    sum_yy = _window_sum(fcst_box**2,grid_window)
+    sum_xy = _window_sum(train_box*fcst_box,grid_window)
+    cov = n_pts*sum_xy - sum_x*sum_y
+    var_x = n_pts*sum_xx - sum_x**2
+    var_y = n_pts*sum_yy - sum_y**2
+    # --- What's left of a flat local domain after cancellation is rounding noise. The window sums are differences
+    # --- of cumulative sums over the whole box, so that noise scales with each date's box-wide sum of squares (the
+    # --- largest cumulative sum), not with the local sums
+    var_x[var_x <= 1e-12*n_pts*np.sum(train_box**2,axis=(1,2),keepdims=True)] = 0.
+    var_y[var_y <= 1e-12*n_pts*np.sum(fcst_box**2)] = 0.
+    with np.errstate(divide='ignore',invalid='ignore'):
+        corr = cov/np.sqrt(var_x*var_y)
+    corr[~np.isfinite(corr)] = 0.
+    out_array[:,i_start:i_stop+1,j_start:j_stop+1] = 1. - np.clip(corr,-1.,1.)
+    return out_array
+
+
+def _mae_analog_grid(train,forecast,out_array,i_start,i_stop,j_start,j_stop, grid_window):
+    """
+    Function to find analogous dates based on mean absolute error.
     :param array:
         Some 2-d numpy array
     :return self:
     """
-    out_array = np.zeros(analog_array.shape)
-    # --- Now find differences at each forecast grid point and local-domain
-    for i in range(i_start,i_stop+1,1): # --- latitudes
-        for j in range(j_start,j_stop+1,1): # --- longitudes
-            out_array[:,i,j] = rd(analog_array[:,i,j],method='ordinal')
+    n_pts = ((grid_window*2)+1)*((grid_window*2)+1)
+    lats = slice(i_start-grid_window,i_stop+grid_window+1)
+    lons = slice(j_start-grid_window,j_stop+grid_window+1)
+    # --- Absolute differences are found once per grid point, then summed over each local domain
+    dtype = out_array.dtype
+    abs_diffs = np.asarray(train[:,lats,lons],dtype=dtype) - forecast[np.newaxis,lats,lons].astype(dtype)
+    np.absolute(abs_diffs,out=abs_diffs)
+    sums = _window_sum(abs_diffs,grid_window)
+    out_array[:,i_start:i_stop+1,j_start:j_stop+1] = np.maximum(sums,0.)/n_pts
     return out_array
 
-@autojit
+def station_distances(meth, values, fcst_values, windows, n_pts, ranks=None, fcst_ranks=None):
+    """
+    Function to find comp_method distances at scattered grid points (stations) rather than over a whole grid.
+    Every point's term (absolute rank difference, squared/absolute difference, ...) is found once, however many
+    local domains share the point, and summed over each local domain with a sparse matrix product.
+    :param values:
+        NumPy array, 2-d (time,n_points) training values at every grid point the local domains touch.
+    :param fcst_values:
+        NumPy array, 1-d (n_points,) forecast values at those points.
+    :param windows:
+        scipy sparse matrix, (n_points,n_cells) number of times each point is in each station cell's local domain
+        (points off the edge of the grid are clamped, so an edge point can count more than once).
+    :param n_pts:
+        integer, number of grid points in a local domain, (2*grid_window+1)**2.
+    :param ranks/fcst_ranks:
+        NumPy arrays shaped like values/fcst_values, training ranks (compact or float) and forecast ranks
+        (forecast_ranks()), only needed for rank.
+    :return distances:
+        NumPy array, 2-d (time,n_cells).
+    """
+    window_sum = lambda terms: windows.T.dot(terms.T).T
+    values = np.asarray(values,dtype=np.float64)
+    if meth == 'rank':
+        # --- The forecast isn't part of the ranked climatology, so bump training ranks above/tied with it
+        adj = expand_ranks(ranks) + (values > fcst_values) + 0.5*(values == fcst_values)
+        return window_sum(np.absolute(adj - fcst_ranks))
+    if meth == 'rmse':
+        return np.sqrt(np.maximum(window_sum((values - fcst_values)**2),0.)/n_pts)
+    if meth == 'mae':
+        return window_sum(np.absolute(values - fcst_values))/n_pts
+    if meth == 'corr':
+        # --- Centre on the forecast mean so the sums don't lose precision to a large offset
+        offset = np.mean(fcst_values)
+        x,y = values - offset,fcst_values - offset
+        sx,sxx,sxy = window_sum(x),window_sum(x*x),window_sum(x*y)
+        sy,syy = window_sum(y[np.newaxis])[0],window_sum((y*y)[np.newaxis])[0]
+        cov = sxy - sx*sy/n_pts
+        var_x = np.maximum(sxx - sx*sx/n_pts,0.)
+        var_y = np.maximum(syy - sy*sy/n_pts,0.)
+        with np.errstate(divide='ignore',invalid='ignore'):
+            corr = cov/np.sqrt(var_x*var_y)
+        # --- A flat local domain has no pattern to correlate
+        corr = np.where(np.isfinite(corr),corr,0.)
+        return 1. - np.clip(corr,-1.,1.)
+    return np.zeros((values.shape[0],windows.shape[1]))
+
+
+def n_analogs_from_frac(n_analogs, n_dates):
+    """
+    Function to turn an n_analogs setting into a number of analogs: values < 1 are a fraction of the training dates.
+    """
+    if n_analogs < 1:
+        return int(np.ceil(n_dates*n_analogs))
+    return int(min(n_analogs,n_dates))
+
+
+def select_analogs(distances,i_start,i_stop,j_start,j_stop,n_analogs):
+    """
+    Function to keep only the n_analogs closest training dates at each forecast grid point. Uses a partial selection
+    (np.partition) so the cost is linear in the number of training dates, then sorts just the selected analogs.
+    Ties go to the earlier training date, same as a stable sort of the whole time axis.
+    :param distances:
+        NumPy array, 3-d (time,lat,lon) array of pattern-match distances, smaller is better.
+    :param n_analogs:
+        integer number of analogs to keep, or if < 1 the fraction of training dates to keep.
+    :return analog_idxs:
+        NumPy array, 3-d (n_analogs,lat,lon) integer array of training date indices, best match first.
+        -1 outside the forecast domain.
+    :return analog_dists:
+        NumPy array, 3-d (n_analogs,lat,lon) array of the matching distances. NaN outside the forecast domain.
+    """
+    n_keep = n_analogs_from_frac(n_analogs,distances.shape[0])
+    domain = distances[:,i_start:i_stop+1,j_start:j_stop+1]
+    ii,jj = np.ogrid[:domain.shape[1],:domain.shape[2]]
+    if n_keep < domain.shape[0]:
+        # --- Every date closer than the n_keep-th distance is kept, the rest of the slots go to the earliest dates
+        # --- tied with it (argpartition alone would keep an arbitrary few of them)
+        kth = np.partition(domain,n_keep-1,axis=0)[n_keep-1]
+        # --- NaN distances sort last, like np.sort
+        closer = (domain < kth) | (np.isnan(kth) & ~np.isnan(domain))
+        tied = (domain == kth) | (np.isnan(domain) & np.isnan(kth))
+        keep = closer | (tied & (np.cumsum(tied,axis=0) <= n_keep - np.sum(closer,axis=0)))
+        # --- Exactly n_keep dates are kept at each grid point, gathered grid point by grid point in date order
+        kept_times = np.nonzero(keep.reshape(keep.shape[0],-1).T)[1]
+        nearest = kept_times.reshape(-1,n_keep).T.reshape((n_keep,)+domain.shape[1:])
+    else:
+        nearest = np.broadcast_to(np.arange(domain.shape[0])[:,np.newaxis,np.newaxis],domain.shape)
+    nearest_dists = domain[nearest,ii,jj]
+    # --- Sort the survivors, ties go to the earlier training date
+    order = np.lexsort((nearest,nearest_dists),axis=0)
+    analog_idxs = np.full((n_keep,)+distances.shape[1:],-1,dtype=np.intp)
+    analog_dists = np.full((n_keep,)+distances.shape[1:],np.nan,dtype=distances.dtype)
+    analog_idxs[:,i_start:i_stop+1,j_start:j_stop+1] = nearest[order,ii,jj]
+    analog_dists[:,i_start:i_stop+1,j_start:j_stop+1] = nearest_dists[order,ii,jj]
+    return analog_idxs,analog_dists
+
+
+def merge_analogs(analog_idxs,analog_dists,distances,first_idx,i_start,i_stop,j_start,j_stop,n_analogs):
+    """
+    Function to fold a block of training dates into a running set of the closest analogs, so the full
+    (time,lat,lon) distances never have to be held at once.
+    :param analog_idxs/analog_dists:
+        NumPy arrays, running 3-d (k,lat,lon) output of select_analogs()/merge_analogs(), or None for the first block.
+    :param distances:
+        NumPy array, 3-d (block,lat,lon) distances for training dates first_idx to first_idx+block-1.
+    :param n_analogs:
+        integer, number of analogs to keep.
+    :return analog_idxs/analog_dists:
+        NumPy arrays, 3-d (<=n_analogs,lat,lon), best match first. Ties go to the earlier training date, same as
+        running select_analogs() over the whole archive.
+    """
+    if analog_idxs is None:
+        analog_idxs = np.zeros((0,)+distances.shape[1:],dtype=np.intp)
+        analog_dists = np.zeros((0,)+distances.shape[1:],dtype=distances.dtype)
+    # --- Running analogs come first and are all earlier dates, so ties still go to the earlier training date
+    cand_dists = np.concatenate((analog_dists,distances))
+    cand_idxs = np.concatenate((analog_idxs,
+                                np.broadcast_to((first_idx+np.arange(distances.shape[0]))[:,np.newaxis,np.newaxis],
+                                                distances.shape)))
+    pos,best_dists = select_analogs(cand_dists,i_start,i_stop,j_start,j_stop,min(n_analogs,cand_dists.shape[0]))
+    best_idxs = np.full(pos.shape,-1,dtype=np.intp)
+    ii,jj = np.ogrid[i_start:i_stop+1,j_start:j_stop+1]
+    best_idxs[:,i_start:i_stop+1,j_start:j_stop+1] = cand_idxs[pos[:,i_start:i_stop+1,j_start:j_stop+1],ii,jj]
+    return best_idxs,best_dists
+
+
+def interp_weights(distances,i_start,i_stop,j_start,j_stop,pct_samps):
+    """
+    Function to find the inverse-distance weight of every training date over the forecast domain. Each variable's
+    distances are min-max scaled over the training dates and combined into a Euclidean distance from a "perfect"
+    match; dates beyond the pct_samps percentile of that distance get no weight. The whole forecast domain is done
+    at once, with the percentile found by partial selection along the time axis.
+    :param distances:
+        NumPy array, 4-d (n_vars,time,lat,lon) per-variable distances, or 3-d (time,lat,lon) for a single variable.
+    :param pct_samps:
+        float, fraction of training dates to use at each grid point.
+    :return weights:
+        NumPy array, 3-d (time,lat,lon) weights over the forecast domain only, summing to 1 at each grid point.
+    """
+    dists = distances[...,i_start:i_stop+1,j_start:j_stop+1]
+    if dists.ndim == 3:
+        dists = dists[np.newaxis]
+    # --- Scratch arrays for the whole domain, allocated once
+    all_distances = np.zeros(dists.shape[1:])
+    weights = np.empty(dists.shape[1:])
+    with np.errstate(divide='ignore',invalid='ignore'):
+        # --- scale distances first
+        for v in range(dists.shape[0]):
+            d_min = np.min(dists[v],axis=0)
+            np.subtract(dists[v],d_min,out=weights)
+            weights /= np.max(dists[v],axis=0) - d_min
+            weights *= weights
+            all_distances += weights
+        np.sqrt(all_distances,out=all_distances) # --- Euclidean distance from "perfect" match
+        # --- First, find maximum distance based on % of samples used
+        max_rad = np.percentile(all_distances,pct_samps*100.,axis=0) # --- max distance
+        np.subtract(max_rad,all_distances,out=weights)
+        weights /= max_rad*all_distances
+        weights *= weights
+        weights[~(all_distances <= max_rad)] = 0.
+        weights /= np.sum(weights,axis=0)
+    return weights
+
+
 def interp_proba(distances,events,i_start,i_stop,j_start,j_stop,pct_samps):
     """
-    Function to find analogous dates based on root mean square error.
-    :param array:
-        Some 2-d numpy array
-    :return self:
+    Function to generate probabilities by inverse-distance weighting the analogs within the closest pct_samps
+    fraction of training dates, see interp_weights().
+    :param distances:
+        NumPy array, 4-d (n_vars,time,lat,lon) per-variable distances, or 3-d (time,lat,lon) for a single variable.
+    :param events:
+        NumPy array, 3-d (time,lat,lon) binary events on the training dates, or 4-d (n_events,time,lat,lon) for
+        several events sharing the same weights.
+    :param pct_samps:
+        float, fraction of training dates to use at each grid point.
+    :return probs:
+        NumPy array, 2-d (lat,lon), or 3-d (n_events,lat,lon) for 4-d events.
     """
-    probs = np.zeros((distances.shape[-2:]))
-    # --- Now find differences at each forecast grid point and local-domain
-    for i in range(i_start,i_stop+1,1): # --- latitudes
-        for j in range(j_start,j_stop+1,1): # --- longitudes
-            temp_events = events[:,i,j]
-            # --- First, find maximum distance based on % of samples used
-            # --- scale distances first
-            scaled_dists = np.ones(distances.shape[:2])
-            for v in range(distances.shape[0]):
-                scaled_dists[v,:] = (distances[v,:,i,j].T - np.min(distances[v,:,i,j]))/(np.max(distances[v,:,i,j]) - np.min(distances[v,:,i,j]))
-            all_distances = np.sqrt(np.sum(scaled_dists.T**2,axis=0)) # --- Euclidean distance from "perfect" match
-            max_rad = np.percentile(all_distances,pct_samps*100.) # --- max distance
-            distance_indices = np.where(all_distances <= max_rad)[0]
-            weights = ((max_rad - all_distances[distance_indices])/(max_rad*all_distances[distance_indices]))**2
-            # --- set up RBF function
-            #print events[:,i,j].max()
-            probs[i,j] = np.sum(weights*temp_events[distance_indices])/np.sum(weights)
-            #rbfi = Rbf(distances[0,:,i,j],distances[1,:,i,j],distances[2,:,i,j],events[:,i,j])
-            #probs[i,j] = rbfi(0,0,0) # --- perfect forecast
+    weights = interp_weights(distances,i_start,i_stop,j_start,j_stop,pct_samps)
+    probs = np.zeros(events.shape[:-3]+events.shape[-2:])
+    with np.errstate(invalid='ignore'):
+        probs[...,i_start:i_stop+1,j_start:j_stop+1] = np.sum(weights*events[...,:,i_start:i_stop+1,j_start:j_stop+1],
+                                                              axis=-3)
     return probs
 
-@autojit
-def gen_proba(distances,events,i_start,i_stop,j_start,j_stop,n_analogs):
+
+def analog_values(analog_idxs,obs,i_start,i_stop,j_start,j_stop,n_analogs):
     """
-    Function to find analogous dates based on root mean square error.
-    :param array:
-        Some 2-d numpy array
-    :return self:
+    Function to gather the training observations of the selected analogs over the forecast domain.
+    :param analog_idxs:
+        NumPy array, 3-d (k,lat,lon) training date indices made by select_analogs(), best match first.
+    :param obs:
+        NumPy array, 3-d (time,lat,lon) observations on the training dates, or 4-d (n_events,time,lat,lon).
+    :param n_analogs:
+        integer number of analogs to use (<= k), or if < 1 the fraction of training dates to use.
+    :return values:
+        NumPy array, 3-d (n_analogs,lat,lon) (4-d for 4-d obs) observations of the best n_analogs analogs over
+        the forecast domain.
+    """
+    n_use = n_analogs_from_frac(n_analogs,obs.shape[-3])
+    if n_use > analog_idxs.shape[0]:
+        raise ValueError("Asked for {} analogs but only {} were kept by find_analogs.".format(n_use,analog_idxs.shape[0]))
+    ii,jj = np.ogrid[i_start:i_stop+1,j_start:j_stop+1]
+    return obs[...,analog_idxs[:n_use,i_start:i_stop+1,j_start:j_stop+1],ii,jj]
+
+
+def threshold_proba(values,thresholds,weights=None,below=False):
+    """
+    Function to turn analog observations into probabilities for a list of thresholds, all sharing the same analogs.
+    :param values:
+        NumPy array, 3-d (n_samples,lat,lon) observations of the analogs.
+    :param thresholds:
+        list or NumPy array of thresholds, either scalars or 2-d (lat,lon) arrays.
+    :param weights:
+        NumPy array, 3-d (n_samples,lat,lon) weights summing to 1, or None for equally weighted analogs.
+    :param below:
+        boolean, if True the probability of values <= threshold (the CDF), otherwise of values > threshold.
+    :return probs:
+        NumPy array, 3-d (n_thresholds,lat,lon).
+    """
+    probs = np.empty((len(thresholds),)+values.shape[1:])
+    for n,thresh in enumerate(thresholds):
+        events = values <= thresh if below else values > thresh
+        if weights is None:
+            probs[n] = np.mean(events,axis=0)
+        else:
+            with np.errstate(invalid='ignore'):
+                probs[n] = np.sum(weights*events,axis=0)
+    return probs
+
+
+def weighted_quantiles(values,weights,quantiles):
+    """
+    Function to find quantiles along the first axis of values. Equally weighted values use np.percentile's linear
+    interpolation, weighted values the inverse of the weighted empirical CDF.
+    :param values:
+        NumPy array, 3-d (n_samples,lat,lon).
+    :param weights:
+        NumPy array, 3-d (n_samples,lat,lon) weights summing to 1, or None.
+    :param quantiles:
+        list or NumPy array of quantiles, between 0 and 1.
+    :return quants:
+        NumPy array, 3-d (n_quantiles,lat,lon).
+    """
+    quantiles = np.asarray(quantiles,dtype=np.float64)
+    if weights is None:
+        return np.percentile(values,quantiles*100.,axis=0)
+    order = np.argsort(values,axis=0)
+    ii,jj = np.ogrid[:values.shape[1],:values.shape[2]]
+    sorted_values = values[order,ii,jj]
+    cum_weights = np.cumsum(weights[order,ii,jj],axis=0)
+    quants = np.empty((quantiles.shape[0],)+values.shape[1:])
+    for n,q in enumerate(quantiles):
+        # --- First value whose cumulative weight reaches q
+        pos = np.minimum(np.sum(cum_weights < q,axis=0),values.shape[0]-1)
+        quants[n] = sorted_values[pos,ii,jj]
+    quants[:,~np.isfinite(cum_weights[-1])] = np.nan
+    return quants
+
+
+def gen_proba_topk(analog_idxs,events,i_start,i_stop,j_start,j_stop,n_analogs):
+    """
+    Function to generate probabilities from the compact analog indices made by select_analogs().
+    :param analog_idxs:
+        NumPy array, 3-d (k,lat,lon) training date indices, best match first.
+    :param events:
+        NumPy array, 3-d (time,lat,lon) binary events on the training dates, or 4-d (n_events,time,lat,lon) for
+        several events sharing the same analogs.
+    :param n_analogs:
+        integer number of analogs to use (<= k), or if < 1 the fraction of training dates to use.
+    :return probs:
+        NumPy array, 2-d (lat,lon), or 3-d (n_events,lat,lon) for 4-d events.
+    """
+    probs = np.zeros(events.shape[:-3]+events.shape[-2:])
+    probs[...,i_start:i_stop+1,j_start:j_stop+1] = np.mean(analog_values(analog_idxs,events,i_start,i_stop,j_start,
+                                                                         j_stop,n_analogs),axis=-3)
+    return probs
+
+
+def warmup(dtypes=(np.float32,np.float64)):
+    """
+    Compatibility shim, does nothing. warmup() used to compile the Numba kernels for dtypes ahead of the first
+    forecast, and is kept so job scripts that still call it at start-up keep working. Every kernel is vectorized
+    NumPy now, so there is nothing to compile: the first call of a new process costs the same as any other.
+    :param dtypes:
+        ignored, only accepted for compatibility.
+    :return signatures:
+        empty list, nothing is compiled.
     """
-    probs = np.zeros((distances.shape[-2:]))
-    # --- Now find differences at each forecast grid point and local-domain
-    for i in range(i_start,i_stop+1,1): # --- latitudes
-        for j in range(j_start,j_stop+1,1): # --- longitudes
-            temp_events = events[:,i,j]
-            # --- First, find maximum distance based on % of samples used
-            # --- scale distances first
-            if n_analogs < 1:
-                distance_indices = np.where(distances[:,i,j] < np.ceil(distances[:,i,j].shape[0]*n_analogs))[0]
-            elif n_analogs >= 1:
-                distance_indices = np.where(distances[:,i,j] < n_analogs)[0]
-            probs[i,j] = np.sum(temp_events[distance_indices])/len(distance_indices)
-    return probs
\ No newline at end of file
+    return []
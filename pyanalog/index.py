@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+
+import os
+import json
+import numpy as np
+from .comp_funcs import rank_columns,compact_ranks,update_rank_climatology,_window_sum
+
+FORMAT_VERSION = 2
+
+
+class AnalogIndex(object):
+    """Training-side statistics of a fixed training archive, stored on disk and loaded memory-mapped."""
+
+    def __init__(self, path, meta, arrays):
+        """
+        Use load_index()/build_index() rather than creating this directly.
+
+        :param path:
+            string, index directory.
+        :param meta:
+            dict, contents of the index's meta.json.
+        :param arrays:
+            dict, {(name,nvar): NumPy array} of the stored statistics.
+        """
+        self.path = path
+        self.meta = meta
+        self.arrays = arrays
+        self.grid_window = meta['grid_window']
+        self.lat_box = tuple(meta['lat_box'])
+        self.lon_box = tuple(meta['lon_box'])
+        self.n_dates = meta['n_dates']
+
+
+    def __repr__(self):
+        return "<AnalogIndex(path={}, grid_window={}, lat_box={}, lon_box={}, n_dates={}, stats={})>".format(
+                        self.path, self.grid_window, self.lat_box, self.lon_box, self.n_dates, sorted(self.arrays))
+
+
+    def get(self, name, nvar=None):
+        """
+        Return a stored statistic, or None if it isn't in the index.
+        :param name:
+            string, one of 'ranks','sorted' (rank climatology of the domain plus halo) or 'sum','sumsq'
+            (per-date sums of values/squared values over each grid point's local domain).
+        :param nvar:
+            integer, variable index for 4-d training data, None for 3-d.
+        """
+        return self.arrays.get((name,nvar))
+
+
+    def matches(self, analog, train_shape):
+        """
+        True if the index was built for the same grid_window, forecast domain and training array shape.
+        """
+        return (self.grid_window == analog.grid_window and
+                self.lat_box == (analog.start_lat_idx,analog.stop_lat_idx) and
+                self.lon_box == (analog.start_lon_idx,analog.stop_lon_idx) and
+                tuple(self.meta['train_shape']) == tuple(train_shape))
+
+
+def _file_name(name, nvar):
+    return '{}.npy'.format(name) if nvar is None else '{}_{}.npy'.format(name,nvar)
+
+
+def build_index(analog, train, path, block_size=256):
+    """
+    Function to precompute everything find_analogs needs from a fixed training archive and write it to disk.
+    Ranked/sorted climatologies are stored for variables matched by rank, and windowed sums/sums of squares
+    for variables matched by RMSE or correlation.
+
+    :param analog:
+        Analog object, sets grid_window, the forecast domain and the method for each variable.
+    :param train:
+        NumPy array (or memory-mapped/chunked array-like), 3-d (time,lat,lon) or 4-d (n_vars,time,lat,lon).
+    :param path:
+        string, directory to write the index to. Created if needed, existing index files are overwritten.
+    :param block_size:
+        integer, number of training dates processed at once for the windowed sums.
+    :return index:
+        AnalogIndex, the new index loaded back memory-mapped.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    g = analog.grid_window
+    n_vars = train.shape[0] if len(train.shape) == 4 else 1
+    n_dates = train.shape[-3]
+    files = []
+    for nvar,meth in enumerate(analog.comp_method[:n_vars]):
+        var = None if len(train.shape) == 3 else nvar
+        key = (slice(None),) if var is None else (var,slice(None))
+        if meth == 'rank':
+            ranks,sorted_clim = rank_columns(analog._halo(train,key),return_sorted=True)
+            for name,data in (('ranks',compact_ranks(ranks)),('sorted',sorted_clim)):
+                np.save(os.path.join(path,_file_name(name,var)),data)
+                files.append([name,var])
+        elif meth in ('rmse','corr'):
+            shape = (n_dates,analog.stop_lat_idx-analog.start_lat_idx+1,analog.stop_lon_idx-analog.start_lon_idx+1)
+            sums = np.lib.format.open_memmap(os.path.join(path,_file_name('sum',var)),mode='w+',shape=shape)
+            sumsq = np.lib.format.open_memmap(os.path.join(path,_file_name('sumsq',var)),mode='w+',shape=shape)
+            for t0 in range(0,n_dates,block_size):
+                times = slice(t0,min(t0+block_size,n_dates))
+                block = analog._halo(train,(times,) if var is None else (var,times)).astype(np.float64)
+                sums[times] = _window_sum(block,g)
+                sumsq[times] = _window_sum(block**2,g)
+            sums.flush()
+            sumsq.flush()
+            del sums,sumsq
+            files.extend([['sum',var],['sumsq',var]])
+
+    meta = {'format_version': FORMAT_VERSION,
+            'grid_window': g,
+            'lat_box': [analog.start_lat_idx,analog.stop_lat_idx],
+            'lon_box': [analog.start_lon_idx,analog.stop_lon_idx],
+            'train_shape': list(train.shape),
+            'n_dates': n_dates,
+            'comp_method': list(analog.comp_method[:n_vars]),
+            'files': files}
+    _write_meta(path,meta)
+    return load_index(path)
+
+
+def _write_meta(path, meta):
+    # --- Write the metadata last, so a half-written index never loads
+    with open(os.path.join(path,'meta.json'),'w') as f:
+        json.dump(meta,f,indent=1)
+
+
+def append_index(analog, index, train, new_train, n_evict=0, block_size=256):
+    """
+    Function to update an index for new training dates (and optionally drop the oldest ones) without rebuilding
+    it. Rank climatologies are updated with update_rank_climatology(), windowed sums are only computed for the new
+    dates. Each stored array is rewritten once.
+    :param analog:
+        Analog object the index was built for.
+    :param index:
+        AnalogIndex, built from train.
+    :param train:
+        NumPy array (or memory-mapped/chunked array-like), the training archive the index was built from.
+    :param new_train:
+        NumPy array, 3-d (n_new,lat,lon) or 4-d (n_vars,n_new,lat,lon) data for the new training dates.
+    :param n_evict:
+        integer, number of oldest training dates to drop.
+    :return index:
+        AnalogIndex, the updated index loaded back memory-mapped.
+    """
+    g = analog.grid_window
+    meta = dict(index.meta)
+    n_new = new_train.shape[-3]
+    updated = {}
+    for name,var in meta['files']:
+        key = (slice(None),) if var is None else (var,slice(None))
+        if name == 'ranks':
+            updated[('ranks',var)],updated[('sorted',var)] = update_rank_climatology(
+                analog._halo(train,key),index.get('ranks',var),index.get('sorted',var),analog._halo(new_train,key),
+                n_evict=n_evict)
+        elif name in ('sum','sumsq'):
+            new_sums = np.empty((n_new,)+index.get(name,var).shape[1:])
+            for t0 in range(0,n_new,block_size):
+                times = slice(t0,min(t0+block_size,n_new))
+                block = analog._halo(new_train,(times,) if var is None else (var,times)).astype(np.float64)
+                new_sums[times] = _window_sum(block if name == 'sum' else block**2,g)
+            updated[(name,var)] = np.concatenate((index.get(name,var)[n_evict:],new_sums))
+    # --- Release the memory maps before the files under them are replaced, and take the index offline until the
+    # --- new metadata is written so a half-updated index never loads
+    index.arrays = {}
+    os.remove(os.path.join(index.path,'meta.json'))
+    for (name,var),data in updated.items():
+        tmp_file = os.path.join(index.path,_file_name(name,var)+'.tmp')
+        with open(tmp_file,'wb') as f:
+            np.save(f,data)
+        os.replace(tmp_file,os.path.join(index.path,_file_name(name,var)))
+    meta['n_dates'] = meta['n_dates'] - n_evict + n_new
+    meta['train_shape'] = list(meta['train_shape'])
+    meta['train_shape'][-3] = meta['n_dates']
+    _write_meta(index.path,meta)
+    return load_index(index.path)
+
+
+def load_index(path, mmap_mode='r'):
+    """
+    Function to load an index written by build_index(). Arrays are memory-mapped, so loading is cheap and only
+    the parts a forecast touches are read from disk.
+    :param path:
+        string, index directory.
+    :param mmap_mode:
+        passed to np.load, None reads everything into memory.
+    :return index:
+        AnalogIndex
+    """
+    meta_file = os.path.join(path,'meta.json')
+    if not os.path.exists(meta_file):
+        raise IOError("No analog index at {} (missing meta.json).".format(path))
+    with open(meta_file) as f:
+        meta = json.load(f)
+    if meta.get('format_version') != FORMAT_VERSION:
+        raise ValueError("Analog index at {} has format version {}, this version of pyanalog reads version {}. "
+                         "Rebuild it with build_index().".format(path,meta.get('format_version'),FORMAT_VERSION))
+    arrays = {}
+    for name,var in meta['files']:
+        arrays[(name,var)] = np.load(os.path.join(path,_file_name(name,var)),mmap_mode=mmap_mode)
+    return AnalogIndex(path,meta,arrays)
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+from concurrent.futures import Future, ProcessPoolExecutor
+from .analog import Analog
+from .readers import open_archive,ArchiveReader,NpyTiles
+from .parallel import n_workers,tile_domain
+from .utils import get_analog_idxs
+
+# --- Per-process cache of open archives and tile Analog objects, so a worker that gets several forecast dates of
+# --- the same tile only ranks the training climatology once
+_worker_cache = {}
+
+
+class LocalScheduler(object):
+    """Stand-in for a cluster scheduler with the submit()/result() interface of concurrent.futures and
+    dask.distributed: every task runs right away in this process and comes back as a finished Future, so a job can
+    be run and debugged (or tested) without any workers."""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args,**kwargs))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+
+    def shutdown(self, wait=True):
+        pass
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        return False
+
+
+def _plain(value):
+    """
+    value with NumPy arrays and scalars, also inside lists, tuples and dicts, turned into plain Python lists and
+    numbers, which json can write.
+    """
+    if isinstance(value,(np.ndarray,np.generic)):
+        return value.tolist()
+    if isinstance(value,(list,tuple)):
+        return [_plain(item) for item in value]
+    if isinstance(value,dict):
+        return dict((key,_plain(item)) for key,item in value.items())
+    return value
+
+
+def _analog_kwargs(analog):
+    """
+    Settings to rebuild an Analog in a worker, for one tile of its forecast domain, as plain Python values (they
+    also go into the job manifest).
+    """
+    return _plain({'grid_window': analog.grid_window, 'comp_method': list(analog.comp_method),
+                   'field_weights': list(analog.field_weights), 'lat_bounds': list(analog.lat_bounds),
+                   'lon_bounds': list(analog.lon_bounds), 'lat_inc': analog.lat_inc, 'lon_inc': analog.lon_inc,
+                   'keep_var_distances': analog.keep_var_distances, 'normalize': analog.normalize,
+                   'dtype': analog.dtype.name})
+
+
+def _content_hash(array):
+    """
+    SHA-1 of an in-memory array's shape, type and values, read a few dates at a time so nothing big is copied.
+    """
+    digest = hashlib.sha1('{}{}'.format(array.shape,array.dtype.str).encode())
+    step = max(1,(1 << 26)//max(1,array[:1].nbytes))
+    for t0 in range(0,array.shape[0],step):
+        digest.update(np.ascontiguousarray(array[t0:t0+step]).data)
+    return digest.hexdigest()
+
+
+def _file_stamps(path):
+    """
+    (name, size, mtime) of a file, or of every file in a directory, to tell whether an input on disk has changed.
+    """
+    paths = sorted(glob.glob(os.path.join(path,'*'))) if os.path.isdir(path) else [path]
+    return [[os.path.basename(name),os.stat(name).st_size,os.stat(name).st_mtime_ns] for name in paths]
+
+
+def _input_source(array, shared_dir, name):
+    """
+    Where workers open an input from, and what it is (recorded in the job manifest): archives already on disk are
+    used where they are and identified by their files' sizes/modification times; in-memory arrays are identified by
+    shape, type and a hash of their values, and get written (see _write_shared()) to a .npy named after that hash
+    in shared_dir, to be memory-mapped by every worker rather than pickled into every task.
+    """
+    if isinstance(array,str):
+        array = open_archive(array)
+    if isinstance(array,ArchiveReader):
+        source = {'path': os.path.abspath(array.path), 'variables': array.variables, 'engine': array.engine}
+    elif isinstance(array,NpyTiles):
+        source = {'path': os.path.abspath(array.directory)}
+    # --- A whole .npy file opened with mmap_mode (not a view of part of it)
+    elif isinstance(array,np.memmap) and array.filename and array.filename.endswith('.npy') and \
+            array.shape == np.load(array.filename,mmap_mode='r').shape and array.flags.c_contiguous:
+        source = {'path': os.path.abspath(array.filename)}
+    else:
+        array = np.asarray(array)
+        sha1 = _content_hash(array)
+        return {'path': os.path.abspath(os.path.join(shared_dir,'{}-{}.npy'.format(name,sha1[:16]))),
+                'shape': list(array.shape), 'dtype': array.dtype.str, 'sha1': sha1}
+    source['files'] = _file_stamps(source['path'])
+    return source
+
+
+def _write_shared(array, source):
+    """
+    Write an in-memory input to the hash-named file of its source, unless an earlier run already did.
+    """
+    if 'sha1' not in source or os.path.exists(source['path']):
+        return
+    tmp_file = source['path'] + '.tmp'
+    with open(tmp_file,'wb') as f:
+        np.save(f,np.asarray(array))
+    os.replace(tmp_file,source['path'])
+
+
+def _open_shared(source):
+    # --- Keyed on the whole source, so a long-lived worker never serves an archive that has changed on disk since
+    key = ('archive',json.dumps(source,sort_keys=True))
+    if key not in _worker_cache:
+        _worker_cache[key] = open_archive(source['path'],variables=source.get('variables'),engine=source.get('engine'))
+    return _worker_cache[key]
+
+
+def _run_task(spec):
+    """
+    Find the analogs (and probabilities) of one forecast date over one tile and checkpoint them. Runs in a worker.
+    """
+    train = _open_shared(spec['train'])
+    forecast = np.asarray(_open_shared(spec['forecasts'])[spec['forecast']])
+    i0,i1,j0,j1 = spec['tile']
+    key = ('analog',spec['work_dir'],spec['tile'])
+    if key not in _worker_cache:
+        kwargs = dict(spec['analog'])
+        all_lats = np.arange(kwargs['lat_bounds'][0],kwargs['lat_bounds'][-1] + 1,kwargs['lat_inc'])
+        all_lons = np.arange(kwargs['lon_bounds'][0],kwargs['lon_bounds'][-1] + 1,kwargs['lon_inc'])
+        _worker_cache[key] = Analog(forecast_lats=[all_lats[i0],all_lats[i1]],forecast_lons=[all_lons[j0],all_lons[j1]],
+                                    crop_output=True,**kwargs)
+    analog = _worker_cache[key]
+    dates = None if spec['dates'] is None else np.asarray(spec['dates'])
+    analog.find_analogs(train,forecast,n_analogs=spec['n_analogs'],block_size=spec['block_size'],dates=dates)
+    out = {'indices': analog.indices, 'distances': analog.analog_distances}
+    if spec['events'] is not None:
+        events = _open_shared(spec['events'])
+        out['proba'] = analog.gen_forecast(events,spec['pct_samps'],thresholds=spec['thresholds'])
+    tmp_file = spec['checkpoint'] + '.tmp.npz'
+    np.savez(tmp_file,**out)
+    os.replace(tmp_file,spec['checkpoint'])
+    return spec['checkpoint']
+
+
+class AnalogJob(object):
+    """Hindcast-sized analog runs split into independent tasks, one per forecast date and forecast-domain tile,
+    handed to any executor with a submit()/result() interface and merged back together. Every finished task is
+    checkpointed in work_dir, so a job that fails part way (or is killed) picks up where it left off when run again."""
+
+    def __init__(self, analog, train, forecasts, work_dir, n_analogs, events=None, pct_samps=None, thresholds=None,
+                 n_tiles=1, block_size=None, train_dates=None, forecast_dates=None, window=1, byear=None, eyear=None,
+                 all_dates=False, month_range=True):
+        """
+        :param analog:
+            Analog object, sets grid_window, comp_method, field_weights, the grid and the forecast domain.
+        :param train:
+            NumPy array, memory-mapped array, archive from open_archive(), or path of one (see
+            Analog.find_analogs). Arrays in memory are written once to work_dir and memory-mapped by the workers,
+            nothing big is pickled into the tasks.
+        :param forecasts:
+            NumPy array (or path), 3-d (n_forecasts,lat,lon) or 4-d (n_forecasts,n_vars,lat,lon) stack of forecasts.
+        :param work_dir:
+            string, directory for the shared inputs and the checkpoints. Reuse it to resume a job; a job with
+            different settings or inputs is refused (ValueError).
+        :param n_analogs:
+            integer number of analogs to keep per grid point, or if < 1 the fraction of training dates to keep.
+        :param events/pct_samps/thresholds:
+            optional, if events (array or path) are given, each task also runs
+            gen_forecast(events,pct_samps,thresholds=thresholds). pct_samps defaults to n_analogs.
+        :param n_tiles:
+            integer, number of forecast-domain tiles each forecast date is split into (see tile_domain()).
+        :param block_size:
+            integer, optional, passed on to find_analogs to bound each task's memory.
+        :param train_dates/forecast_dates/window/byear/eyear/all_dates/month_range:
+            optional cross validation rules, see Analog.find_analogs_batch.
+        """
+        if (train_dates is None) != (forecast_dates is None):
+            raise ValueError("Need both train_dates and forecast_dates to apply cross validation rules.")
+        if isinstance(forecasts,str):
+            forecasts = open_archive(forecasts)
+        if forecast_dates is not None and len(forecast_dates) != forecasts.shape[0]:
+            raise ValueError("Number of forecast_dates doesn't equal number of forecasts.")
+        if not os.path.isdir(work_dir):
+            os.makedirs(work_dir)
+        self.analog = analog
+        self.work_dir = work_dir
+        self.n_analogs = n_analogs
+        self.pct_samps = n_analogs if pct_samps is None else pct_samps
+        self.thresholds = None if thresholds is None else [float(thresh) for thresh in thresholds]
+        self.block_size = block_size
+        self.n_forecasts = forecasts.shape[0]
+        self.tiles = tile_domain(analog.start_lat_idx,analog.stop_lat_idx,analog.start_lon_idx,analog.stop_lon_idx,
+                                 n_tiles)
+        self.forecast_dates = forecast_dates
+        self.date_args = (window,byear,eyear,all_dates,month_range)
+
+        shared = os.path.join(work_dir,'shared')
+        if not os.path.isdir(shared):
+            os.makedirs(shared)
+        inputs = {'train': train, 'forecasts': forecasts, 'events': events}
+        self.sources = dict((name,None if array is None else _input_source(array,shared,name))
+                            for name,array in inputs.items())
+        self.train_days = None
+        if train_dates is not None:
+            self.train_days = np.array(train_dates,dtype='datetime64[D]')
+        self._check_manifest()
+        for name,array in inputs.items():
+            if array is not None:
+                _write_shared(array,self.sources[name])
+
+
+    def __repr__(self):
+        return "<AnalogJob(work_dir={}, n_forecasts={}, n_tiles={}, done={}/{})>".format(
+                        self.work_dir,self.n_forecasts,len(self.tiles),len(self.tasks())-len(self.pending()),
+                        len(self.tasks()))
+
+
+    def _check_manifest(self):
+        """
+        Write the job's settings and inputs next to its checkpoints, or make sure they match the ones already there,
+        so checkpoints from a different job are never merged in.
+        """
+        manifest = {'analog': _analog_kwargs(self.analog),
+                    'inputs': self.sources,
+                    'domain': [self.analog.start_lat_idx,self.analog.stop_lat_idx,self.analog.start_lon_idx,
+                               self.analog.stop_lon_idx],
+                    'n_forecasts': self.n_forecasts,
+                    'tiles': [list(tile) for tile in self.tiles],
+                    'n_analogs': self.n_analogs,
+                    'pct_samps': self.pct_samps if self.sources['events'] is not None else None,
+                    'thresholds': self.thresholds,
+                    'forecast_dates': None if self.forecast_dates is None else
+                                      [str(np.datetime64(date,'D')) for date in self.forecast_dates],
+                    'date_args': list(self.date_args)}
+        manifest = json.loads(json.dumps(_plain(manifest)))
+        manifest_file = os.path.join(self.work_dir,'job.json')
+        if os.path.exists(manifest_file):
+            with open(manifest_file) as f:
+                if json.load(f) != manifest:
+                    raise ValueError("{} holds a different job (settings or inputs have changed), use a new "
+                                     "work_dir.".format(self.work_dir))
+        else:
+            with open(manifest_file,'w') as f:
+                json.dump(manifest,f,indent=1)
+
+
+    def _checkpoint(self, nfcst, ntile):
+        return os.path.join(self.work_dir,'task_{:06d}_{:04d}.npz'.format(nfcst,ntile))
+
+
+    def tasks(self):
+        """
+        Every (forecast index, tile index) pair of the job.
+        """
+        return [(nfcst,ntile) for nfcst in range(self.n_forecasts) for ntile in range(len(self.tiles))]
+
+
+    def pending(self):
+        """
+        Tasks without a checkpoint yet.
+        """
+        return [task for task in self.tasks() if not os.path.exists(self._checkpoint(*task))]
+
+
+    def _spec(self, nfcst, ntile):
+        dates = None
+        if self.forecast_dates is not None:
+            window,byear,eyear,all_dates,month_range = self.date_args
+            dates = get_analog_idxs(self.forecast_dates[nfcst],self.train_days,window,byear,eyear,all_dates=all_dates,
+                                    month_range=month_range)
+        return {'analog': _analog_kwargs(self.analog), 'work_dir': self.work_dir, 'tile': self.tiles[ntile],
+                'train': self.sources['train'], 'forecasts': self.sources['forecasts'], 'events': self.sources['events'],
+                'forecast': nfcst, 'dates': dates, 'n_analogs': self.n_analogs, 'block_size': self.block_size,
+                'pct_samps': self.pct_samps, 'thresholds': self.thresholds,
+                'checkpoint': self._checkpoint(nfcst,ntile)}
+
+
+    def run(self, executor=None, n_jobs=-1):
+        """
+        Run every pending task and merge the results.
+        :param executor:
+            anything with submit(fn,*args) returning a future with result(): a concurrent.futures executor, a
+            dask.distributed Client, a LocalScheduler, ... Its workers need to see work_dir. Default: a process pool
+            of n_jobs workers, shut down afterwards.
+        :param n_jobs:
+            integer, workers of the default process pool, < 0 counts back from the number of cores.
+        :return results:
+            see results(). If any task fails, the others still finish and are checkpointed, then a RuntimeError
+            is raised; running the job again only reruns what's missing.
+        """
+        pending = self.pending()
+        own_executor = executor is None and len(pending) > 0
+        if own_executor:
+            executor = ProcessPoolExecutor(max_workers=min(n_workers(n_jobs),len(pending)))
+        try:
+            futures = [(task,executor.submit(_run_task,self._spec(*task))) for task in pending]
+            failed = []
+            for task,future in futures:
+                try:
+                    future.result()
+                except Exception as exc:
+                    failed.append((task,exc))
+        finally:
+            if own_executor:
+                executor.shutdown()
+        if failed:
+            raise RuntimeError("{} of {} tasks failed, rerun the job to retry them. First failure, (forecast,tile) "
+                               "{}: {!r}".format(len(failed),len(pending),failed[0][0],failed[0][1]))
+        return self.results()
+
+
+    def results(self):
+        """
+        Merge the checkpoints of a finished job.
+        :return analog_idxs/analog_dists:
+            NumPy arrays, 4-d (n_forecasts,n_analogs,lat,lon) training date indices/distances, best match first,
+            on the full grid or just the forecast domain following the template Analog's crop_output.
+        :return proba:
+            NumPy array, (n_forecasts,lat,lon) (or (n_forecasts,n_thresholds,lat,lon)) gen_forecast output, None
+            without events.
+        """
+        missing = self.pending()
+        if missing:
+            raise ValueError("{} of {} tasks haven't finished, run() the job first.".format(len(missing),
+                                                                                            len(self.tasks())))
+        an = self.analog
+        analog_idxs,analog_dists,proba = None,None,None
+        for nfcst,ntile in self.tasks():
+            i0,i1,j0,j1 = self.tiles[ntile]
+            box = (nfcst,Ellipsis,slice(i0-an.start_lat_idx,i1-an.start_lat_idx+1),
+                   slice(j0-an.start_lon_idx,j1-an.start_lon_idx+1))
+            with np.load(self._checkpoint(nfcst,ntile)) as data:
+                if analog_idxs is None:
+                    analog_idxs = np.full((self.n_forecasts,data['indices'].shape[0])+an._domain_shape(),-1,
+                                          dtype=np.intp)
+                    analog_dists = np.full(analog_idxs.shape,np.nan)
+                    if 'proba' in data:
+                        proba = np.zeros((self.n_forecasts,)+data['proba'].shape[:-2]+an._domain_shape())
+                analog_idxs[box] = data['indices']
+                analog_dists[box] = data['distances']
+                if proba is not None:
+                    proba[box] = data['proba']
+        return (an._output(analog_idxs,-1),an._output(analog_dists,np.nan),
+                None if proba is None else an._output(proba))
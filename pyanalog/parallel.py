@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from .comp_funcs import _rank_analog_grid,_rmse_analog_grid,_mae_analog_grid,_corr_analog_grid
+
+_kernels = {'rank': _rank_analog_grid, 'rmse': _rmse_analog_grid, 'mae': _mae_analog_grid, 'corr': _corr_analog_grid}
+
+
+def n_workers(n_jobs):
+    """
+    Function to turn an n_jobs setting into a number of workers, n_jobs < 0 counts back from the number of cores
+    (-1 uses every core, -2 all but one, ...).
+    """
+    if n_jobs < 0:
+        return max((os.cpu_count() or 1) + 1 + n_jobs, 1)
+    return max(n_jobs, 1)
+
+
+def tile_domain(i_start,i_stop,j_start,j_stop,n_tiles):
+    """
+    Function to split a forecast domain into roughly square latitude/longitude tiles.
+    :param i_start/i_stop/j_start/j_stop:
+        integers, first/last (inclusive) latitude/longitude indices of the forecast domain.
+    :param n_tiles:
+        integer, number of tiles wanted. Fewer are returned if the domain is too small.
+    :return tiles:
+        list of (i_start,i_stop,j_start,j_stop) tuples, inclusive like the inputs.
+    """
+    n_lats = i_stop - i_start + 1
+    n_lons = j_stop - j_start + 1
+    # --- Split the longer side more often so tiles (and their halos) stay close to square
+    n_i = int(min(max(np.round(np.sqrt(n_tiles*float(n_lats)/n_lons)),1),n_lats))
+    n_j = int(min(max(int(np.ceil(n_tiles/float(n_i))),1),n_lons))
+    tiles = []
+    for lats in np.array_split(np.arange(i_start,i_stop+1),n_i):
+        for lons in np.array_split(np.arange(j_start,j_stop+1),n_j):
+            tiles.append((int(lats[0]),int(lats[-1]),int(lons[0]),int(lons[-1])))
+    return tiles
+
+
+def tile_distances(methods,train_boxes,fcst_boxes,grid_window,weights,stats,keep_vars=False,dtype=np.float64):
+    """
+    Function to find the weighted total distance over all variables for one forecast-domain tile. Each variable's
+    distances are weighted in place and added into the total as soon as they are found.
+    :param methods:
+        list of strings, comparison method for each variable ('rank','rmse','mae','corr').
+    :param train_boxes/fcst_boxes:
+        lists of NumPy arrays, 3-d (time,lat,lon)/2-d (lat,lon) data for each variable covering the tile plus
+        grid_window points on every side.
+    :param weights:
+        list of floats, weight for each variable.
+    :param stats:
+        list of dicts, optional precomputed statistics for each variable passed on to the kernel as keyword
+        arguments (e.g. train_ranks/fcst_ranks for rank, train_sumsq for rmse, train_sum/train_sumsq for corr).
+    :param keep_vars:
+        boolean, if True also return each variable's weighted distances.
+    :param dtype:
+        NumPy float type of the distances, the kernels cast their inputs to it.
+    :return total:
+        NumPy array, 3-d (time,lat,lon) weighted sum of distances over the tile (without the halo).
+    :return var_dists:
+        list of 3-d (time,lat,lon) weighted distances per variable, or None if keep_vars is False.
+    """
+    n_lats = train_boxes[0].shape[1] - 2*grid_window
+    n_lons = train_boxes[0].shape[2] - 2*grid_window
+    tile = (slice(None),slice(grid_window,grid_window+n_lats),slice(grid_window,grid_window+n_lons))
+    total = np.zeros((train_boxes[0].shape[0],n_lats,n_lons),dtype=dtype)
+    var_dists = [] if keep_vars else None
+    out_array = None
+    for meth,train_box,fcst_box,weight,var_stats in zip(methods,train_boxes,fcst_boxes,weights,stats):
+        if out_array is None or out_array.shape != train_box.shape:
+            out_array = np.zeros(train_box.shape,dtype=dtype)
+        if meth in _kernels:
+            _kernels[meth](train_box,fcst_box,out_array,grid_window,grid_window+n_lats-1,grid_window,
+                           grid_window+n_lons-1,grid_window,**var_stats)
+        else:
+            out_array[tile] = 0.
+        dists = out_array[tile]
+        dists *= weight
+        total += dists
+        if keep_vars:
+            var_dists.append(dists.copy())
+    return total,var_dists
+
+
+def worker_pool(n_jobs=1,parallel='threads'):
+    """
+    Function to start the pool of workers map_tasks spreads tasks over. Starting workers (processes especially)
+    isn't free, so one pool is meant to serve every block/forecast of a find_analogs/find_analogs_batch call.
+    :param n_jobs:
+        integer, number of workers, < 0 counts back from the number of cores.
+    :param parallel:
+        string, 'threads' or 'processes'. The NumPy kernels release the GIL for most of their work so threads
+        avoid copying data to workers; processes pickle every task's arrays.
+    :return pool:
+        concurrent.futures executor, or None for a single worker (everything runs in the calling thread).
+    """
+    workers = n_workers(n_jobs)
+    if parallel not in ('threads','processes'):
+        raise ValueError("parallel must be 'threads' or 'processes', not {}".format(parallel))
+    if workers <= 1:
+        return None
+    if parallel == 'threads':
+        return ThreadPoolExecutor(max_workers=workers)
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def map_tasks(func,tasks,n_jobs=1,parallel='threads',pool=None):
+    """
+    Function to run func(*task) for every task, in order, optionally spread across several cores.
+    :param tasks:
+        list of argument tuples.
+    :param n_jobs/parallel:
+        without a pool, a pool of n_jobs workers (see worker_pool()) is started just for these tasks.
+    :param pool:
+        concurrent.futures executor from worker_pool(), optional, reused rather than starting a new one.
+    :return results:
+        list of func(*task) in the same order as tasks.
+    """
+    if len(tasks) <= 1 or (pool is None and n_workers(n_jobs) <= 1):
+        return [func(*task) for task in tasks]
+    if pool is not None:
+        return list(pool.map(func,*zip(*tasks)))
+    with worker_pool(min(n_workers(n_jobs),len(tasks)),parallel) as pool:
+        return list(pool.map(func,*zip(*tasks)))
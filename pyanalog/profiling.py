@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+import time
+import logging
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger('pyanalog')
+
+
+class _NullStage(object):
+    """Stand-in for Profiler.stage() when profiling is off, so instrumented code costs one method call."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_STAGE = _NullStage()
+
+
+class CallStats(object):
+    """Stage timings of one find_analogs/find_analogs_batch/gen_forecast/... call."""
+
+    def __init__(self, call, n_points=0):
+        """
+        :param call:
+            string, name of the Analog method.
+        :param n_points:
+            integer, number of forecast-domain grid points.
+        """
+        self.call = call
+        self.n_points = n_points
+        self.n_dates = 0
+        self.seconds = 0.
+        self.stages = []
+
+
+    def __repr__(self):
+        return "<CallStats(call={}, seconds={:.4f}, n_points={}, n_dates={}, stages={})>".format(
+                        self.call, self.seconds, self.n_points, self.n_dates,
+                        ', '.join('{}={:.4f}s'.format(name,secs) for name,secs in self.stage_seconds().items()))
+
+
+    def stage_seconds(self):
+        """
+        Wall time per stage name, summed over repeats (e.g. one 'distances' stage per block of training dates).
+        :return seconds:
+            dict, {stage name: seconds} in the order the stages first ran.
+        """
+        seconds = {}
+        for stage in self.stages:
+            seconds[stage['name']] = seconds.get(stage['name'],0.) + stage['seconds']
+        return seconds
+
+
+    def as_dict(self):
+        """
+        Plain-dict version, e.g. for json.dump.
+        """
+        return {'call': self.call,
+                'seconds': self.seconds,
+                'n_points': self.n_points,
+                'n_dates': self.n_dates,
+                'points_dates_per_second': self.n_points*self.n_dates/self.seconds if self.seconds > 0 else None,
+                'stages': [dict(stage) for stage in self.stages]}
+
+
+class Profiler(object):
+    """Collects CallStats for an Analog object, see Analog(profile=...)."""
+
+    def __init__(self, callback=None, track_memory=False):
+        """
+        :param callback:
+            callable, optional. Called with the CallStats of every finished call.
+        :param track_memory:
+            boolean, if True also record the peak bytes allocated in each stage with tracemalloc. tracemalloc
+            slows NumPy allocations down noticeably, so this is off by default.
+        """
+        self.callback = callback
+        self.track_memory = track_memory
+        self.current = None
+        self.last = None
+
+
+    @contextmanager
+    def call(self, name, n_points=0):
+        """
+        Time one public call. Calls made while another is running (e.g. gen_forecast inside a user's callback)
+        are folded into the outer call.
+        """
+        if self.current is not None:
+            yield self.current
+            return
+        stats = CallStats(name,n_points)
+        started_tracing = self.track_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        self.current = stats
+        t0 = time.perf_counter()
+        try:
+            yield stats
+        finally:
+            stats.seconds = time.perf_counter() - t0
+            self.current = None
+            if started_tracing:
+                tracemalloc.stop()
+            self.last = stats
+            logger.debug("%r",stats)
+            if self.callback is not None:
+                self.callback(stats)
+
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time one stage of the current call.
+        """
+        if self.current is None:
+            yield
+            return
+        tracing = self.track_memory and tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            start_bytes = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage = {'name': name, 'seconds': time.perf_counter() - t0}
+            if tracing:
+                stage['peak_bytes'] = tracemalloc.get_traced_memory()[1] - start_bytes
+            self.current.stages.append(stage)
+
+
+    def count_dates(self, n_dates):
+        """
+        Add to the number of training dates compared in the current call.
+        """
+        if self.current is not None:
+            self.current.n_dates += n_dates
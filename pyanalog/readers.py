@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+import os
+import glob
+import itertools
+import threading
+import importlib.util
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+def _as_key(key, ndim):
+    """
+    Full-length indexing tuple for an ndim array.
+    """
+    if not isinstance(key,tuple):
+        key = (key,)
+    if any(k is Ellipsis for k in key):
+        n = key.index(Ellipsis)
+        key = key[:n] + (slice(None),)*(ndim-len(key)+1) + key[n+1:]
+    return key + (slice(None),)*(ndim-len(key))
+
+
+def _read_times(read, times, n_times):
+    """
+    Read an index array of sorted training dates as the fewest contiguous slices (netCDF/HDF5 reads are much faster
+    by hyperslab than by scattered index), with read(slice) returning data with time as the first axis.
+    """
+    if not isinstance(times,np.ndarray) and not isinstance(times,list):
+        return read(times)
+    times = np.asarray(times,dtype=np.intp)
+    times = np.where(times < 0,times+n_times,times)
+    if times.size == 0:
+        return read(slice(0,0))
+    starts = np.flatnonzero(np.diff(times,prepend=times[0]-2) != 1)
+    stops = np.append(starts[1:],times.size)
+    runs = [read(slice(times[i0],times[i1-1]+1)) for i0,i1 in zip(starts,stops)]
+    return runs[0] if len(runs) == 1 else np.concatenate(runs)
+
+
+def _packing(attrs):
+    """
+    (dtype,scale_factor,add_offset) of a CF-packed variable, from a mapping of its attributes, or None if it isn't
+    packed. The unpacked values take the type of scale_factor/add_offset.
+    """
+    if 'scale_factor' not in attrs and 'add_offset' not in attrs:
+        return None
+    scale = np.asarray(attrs.get('scale_factor',1.)).reshape(())
+    offset = np.asarray(attrs.get('add_offset',0.)).reshape(())
+    dtype = np.result_type(*[value for name,value in (('scale_factor',scale),('add_offset',offset)) if name in attrs])
+    return dtype,scale.astype(dtype),offset.astype(dtype)
+
+
+def _n_kept(key):
+    """
+    Number of axes an indexing tuple keeps (integers drop theirs).
+    """
+    return sum(1 for k in key if not isinstance(k,(int,np.integer)))
+
+
+class ArchiveReader(object):
+    """
+    Array-like view of (time,lat,lon) variables in a netCDF4/HDF5 file, for passing as train to Analog.find_analogs.
+    Nothing is loaded up front: indexing reads only the requested box from disk. Packed variables (scale_factor/
+    add_offset attributes) are unpacked the same way whichever engine reads them; fill values aren't masked.
+    """
+
+    def __init__(self, path, variables=None, engine=None):
+        """
+        :param path:
+            string, netCDF4 (.nc, .nc4) or HDF5 (.h5, .hdf5, ...) file.
+        :param variables:
+            string or list of variable names. One variable gives a (time,lat,lon) archive, several give a
+            (n_vars,time,lat,lon) archive in that order. Default: every 3-d variable in the file.
+        :param engine:
+            string, 'netcdf4' or 'h5py'. Default: netCDF4 for .nc/.nc4 files if it is installed, h5py otherwise
+            (netCDF4 files are HDF5 files, so h5py reads them too).
+        """
+        if engine is None:
+            engine = 'h5py'
+            if (os.path.splitext(path)[1].lower() in ('.nc','.nc4','.cdf') and
+                    importlib.util.find_spec('netCDF4') is not None):
+                engine = 'netcdf4'
+        if engine == 'netcdf4':
+            import netCDF4
+            self._file = netCDF4.Dataset(path,'r')
+            # --- Plain raw arrays like h5py returns, unpacking is done in _read for both engines
+            self._file.set_auto_maskandscale(False)
+            file_vars = self._file.variables
+            var_attrs = lambda var: dict((name,var.getncattr(name)) for name in var.ncattrs())
+        elif engine == 'h5py':
+            try:
+                import h5py
+            except ImportError:
+                raise ImportError("Reading {} needs h5py (or netCDF4 for netCDF files).".format(path))
+            self._file = h5py.File(path,'r')
+            file_vars = dict((name,var) for name,var in self._file.items() if isinstance(var,h5py.Dataset))
+            var_attrs = lambda var: var.attrs
+        else:
+            raise ValueError("engine must be 'netcdf4' or 'h5py', not {}".format(engine))
+
+        if variables is None:
+            variables = [name for name,var in file_vars.items() if len(var.shape) == 3]
+        elif isinstance(variables,str):
+            variables = [variables]
+        if not variables:
+            raise ValueError("No (time,lat,lon) variables in {}.".format(path))
+        self.path = path
+        self.engine = engine
+        self.variables = list(variables)
+        self._vars = [file_vars[name] for name in self.variables]
+        var_shape = tuple(self._vars[0].shape)
+        for name,var in zip(self.variables,self._vars):
+            if len(var.shape) != 3 or tuple(var.shape) != var_shape:
+                raise ValueError("Variable {} has shape {}, expected {} (time,lat,lon).".format(name,var.shape,
+                                                                                              var_shape))
+        self.shape = var_shape if len(self._vars) == 1 else (len(self._vars),)+var_shape
+        self.ndim = len(self.shape)
+        self._packing = [_packing(var_attrs(var)) for var in self._vars]
+        # --- The dtype reads come back as, after unpacking
+        self.dtype = np.result_type(*[var.dtype if packing is None else packing[0]
+                                      for var,packing in zip(self._vars,self._packing)])
+        # --- netCDF4 isn't thread-safe, and reads may come from a prefetch thread
+        self._lock = threading.Lock()
+
+
+    def __repr__(self):
+        return "<ArchiveReader(path={}, variables={}, shape={}, engine={})>".format(self.path,self.variables,
+                                                                                   self.shape,self.engine)
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __getitem__(self, key):
+        key = _as_key(key,self.ndim)
+        if self.ndim == 3:
+            return self._read(0,key)
+        var_key = key[0]
+        if isinstance(var_key,(int,np.integer)):
+            return self._read(var_key,key[1:])
+        return np.stack([self._read(nvar,key[1:]) for nvar in np.arange(len(self._vars))[var_key]])
+
+
+    def _read(self, nvar, key):
+        times,lats,lons = key
+        var,packing = self._vars[nvar],self._packing[nvar]
+        with self._lock:
+            data = _read_times(lambda t: np.asarray(var[t,lats,lons]),times,var.shape[0])
+        if packing is None:
+            return data
+        dtype,scale,offset = packing
+        return data.astype(dtype)*scale + offset
+
+
+    def close(self):
+        self._file.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class NpyTiles(object):
+    """
+    Array-like view of a directory of .npy files, each a (time,lat,lon) or (n_vars,time,lat,lon) chunk of training
+    dates, joined along time in file name order. Each file is memory-mapped, so indexing only reads the requested box.
+    """
+
+    def __init__(self, directory, pattern='*.npy'):
+        """
+        :param directory:
+            string, directory holding the tiles.
+        :param pattern:
+            string, glob pattern of the tile files.
+        """
+        paths = sorted(glob.glob(os.path.join(directory,pattern)))
+        if not paths:
+            raise ValueError("No {} files in {}.".format(pattern,directory))
+        self.directory = directory
+        self.paths = paths
+        self._tiles = [np.load(path,mmap_mode='r') for path in paths]
+        first = self._tiles[0]
+        if first.ndim not in (3,4):
+            raise ValueError("{} has shape {}, expected (time,lat,lon) or (n_vars,time,lat,lon).".format(paths[0],
+                                                                                                       first.shape))
+        self._time_axis = first.ndim - 3
+        for path,tile in zip(paths,self._tiles):
+            if tile.ndim != first.ndim or tile.shape[:self._time_axis] + tile.shape[-2:] != \
+                    first.shape[:self._time_axis] + first.shape[-2:]:
+                raise ValueError("Tile {} has shape {}, which doesn't line up with {}.".format(path,tile.shape,
+                                                                                              first.shape))
+        self._bounds = np.cumsum([0]+[tile.shape[self._time_axis] for tile in self._tiles])
+        shape = list(first.shape)
+        shape[self._time_axis] = int(self._bounds[-1])
+        self.shape = tuple(shape)
+        self.ndim = len(self.shape)
+        self.dtype = np.result_type(*[tile.dtype for tile in self._tiles])
+
+
+    def __repr__(self):
+        return "<NpyTiles(directory={}, n_tiles={}, shape={})>".format(self.directory,len(self.paths),self.shape)
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def __getitem__(self, key):
+        key = _as_key(key,self.ndim)
+        lead,(times,lats,lons) = key[:self._time_axis],key[self._time_axis:]
+        single = isinstance(times,(int,np.integer))
+        data = _read_times(lambda t: self._read_slice(lead,t,lats,lons),[times] if single else times,
+                           self.shape[self._time_axis])
+        # --- _read_slice puts time first, move it back behind any variable axis
+        return data[0] if single else np.moveaxis(data,0,_n_kept(lead))
+
+
+    def _read_slice(self, lead, times, lats, lons):
+        """
+        A contiguous time slice, time axis first, taken from whichever tiles it spans.
+        """
+        start,stop,step = times.indices(self.shape[self._time_axis])
+        if step != 1:
+            return _read_times(lambda t: self._read_slice(lead,t,lats,lons),np.arange(start,stop,step),
+                               self.shape[self._time_axis])
+        spans = [(ntile,max(start,b0)-b0,min(stop,b1)-b0)
+                 for ntile,(b0,b1) in enumerate(zip(self._bounds[:-1],self._bounds[1:])) if max(start,b0) < min(stop,b1)]
+        parts = [np.moveaxis(np.asarray(self._tiles[ntile][lead+(slice(t0,t1),lats,lons)]),_n_kept(lead),0)
+                 for ntile,t0,t1 in spans or [(0,0,0)]]
+        return parts[0] if len(parts) == 1 else np.concatenate(parts)
+
+
+def open_archive(path, variables=None, engine=None):
+    """
+    Open a training archive on disk without loading it: a .npy file (memory-mapped), a directory of .npy time-chunk
+    tiles (NpyTiles), or a netCDF4/HDF5 file (ArchiveReader). The result can be passed as train to
+    Analog.find_analogs, which only reads the forecast domain plus grid_window halo.
+    :param variables:
+        string or list of variable names in a netCDF4/HDF5 file, see ArchiveReader.
+    :param engine:
+        string, 'netcdf4' or 'h5py' for netCDF4/HDF5 files, see ArchiveReader.
+    """
+    if os.path.isdir(path):
+        return NpyTiles(path)
+    if os.path.splitext(path)[1].lower() == '.npy':
+        return np.load(path,mmap_mode='r')
+    return ArchiveReader(path,variables=variables,engine=engine)
+
+
+def prefetch(func, items, depth=1):
+    """
+    Yield func(item) for each item in order, with up to depth items computed ahead in a background thread, so
+    reading the next block of training data overlaps with the distance computation on the current one.
+    :param depth:
+        integer, number of results to compute ahead. 0 computes each one when it's asked for.
+    """
+    items = iter(items)
+    if depth < 1:
+        for item in items:
+            yield func(item)
+        return
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        pending = deque(pool.submit(func,item) for item in itertools.islice(items,depth))
+        while pending:
+            future = pending.popleft()
+            for item in itertools.islice(items,1):
+                pending.append(pool.submit(func,item))
+            yield future.result()
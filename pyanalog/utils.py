@@ -1,6 +1,4 @@
 import numpy as np
-from datetime import datetime, timedelta
-import itertools
 
 
 def find_nearest_idx(array, value):
@@ -8,6 +6,80 @@ def find_nearest_idx(array, value):
     return idx
 
 
+# --- Candidate dates for each (month, day, window, byear, eyear, mode), see _window_dates()
+_window_cache = {}
+
+
+def _years(dates):
+    return dates.astype('datetime64[Y]').astype(int) + 1970
+
+
+def _month_starts(months):
+    """First day of each month, months counted from 1970-01."""
+    return np.asarray(months).astype('datetime64[M]').astype('datetime64[D]')
+
+
+def _window_dates(month, day, window, byear, eyear, mode):
+    """
+    Candidate dates around month/day in every year from byear to eyear, before any cross validation. Memoized, so
+    only the first forecast for each calendar day pays for building them.
+
+    mode - 'month': the window months before/after the month, 'day': window days before to window-1 days after
+        the day, '1mo': the day to the end of its month (at most 35 days), 'all': every day.
+
+    Returns:
+     dates - datetime64[D] array of candidate dates, sorted
+     anchors - year of the anchor date each candidate came from (dates in the forecast year's window are dropped)
+    """
+    key = (month,day,window,byear,eyear,mode)
+    if key not in _window_cache:
+        years = np.arange(byear,eyear+1)
+        if mode == 'all':
+            dates = np.arange(_month_starts((byear-1970)*12),_month_starts((eyear+1-1970)*12))
+            anchors = _years(dates)
+        else:
+            months = (years-1970)*12 + month - 1
+            first = _month_starts(months)
+            # --- 2/29 in a non-leap year falls back to 2/28
+            n_days = (_month_starts(months+1) - first).astype(int)
+            anchor_dates = first + np.minimum(day,n_days) - 1
+            if mode == 'month':
+                starts,stops = _month_starts(months-window),_month_starts(months+window+1)
+            elif mode == 'day':
+                starts,stops = anchor_dates - window,anchor_dates + max(window,1)
+            elif mode == '1mo':
+                starts,stops = anchor_dates,np.minimum(anchor_dates + 35,_month_starts(months+1))
+            else:
+                raise ValueError("mode must be 'month', 'day', '1mo' or 'all', not {}".format(mode))
+            n_dates = (stops - starts).astype(int)
+            anchors = np.repeat(years,n_dates)
+            # --- Each year's dates are a run of consecutive days starting at its window start
+            offsets = np.arange(n_dates.sum()) - np.repeat(np.cumsum(n_dates) - n_dates,n_dates)
+            dates = np.repeat(starts,n_dates) + offsets
+        in_years = (_years(dates) >= byear) & (_years(dates) <= eyear)
+        _window_cache[key] = (dates[in_years],anchors[in_years])
+    return _window_cache[key]
+
+
+def _analog_days(forecast_date, window, byear, eyear, mode, min_gap=None):
+    """
+    Candidate dates for forecast_date with leave-one-year-out cross validation applied: nothing from the forecast
+    year, or from a window anchored in it. If min_gap is given, dates within min_gap days of the forecast date
+    are dropped too.
+    """
+    fday = np.datetime64(forecast_date,'D')
+    fdate = fday.astype(object)
+    dates,anchors = _window_dates(fdate.month,fdate.day,window,byear,eyear,mode)
+    keep = (anchors != fdate.year) & (_years(dates) != fdate.year)
+    if min_gap is not None:
+        keep &= np.abs((dates - fday).astype(int)) > min_gap
+    return np.unique(dates[keep])
+
+
+def _as_datetimes(dates):
+    return dates.astype('datetime64[us]').tolist()
+
+
 def get_1mo_dates(inyr, inmo, indate, byear, eyear):
     """
  Used with netCDF4 files and py-netCDF.
@@ -25,41 +97,38 @@ def get_1mo_dates(inyr, inmo, indate, byear, eyear):
  Returns:
  outdates - List of dates meeting the criteria
     """
+    dates,anchors = _window_dates(inmo,indate,35,byear,eyear,'1mo')
+    keep = (anchors != inyr) & (_years(dates) != inyr)
+    return _as_datetimes(np.unique(dates[keep]))
 
-    fnlist = []
-
-    # print inmo,indate
-    try:
-        xdate = datetime(byear, inmo, indate)
-    except ValueError:
-        xdate = datetime(byear, inmo, indate - 1)
-    else:
-        xdate = datetime(byear, inmo, indate)
-    while xdate < datetime(eyear + 1, 1, 1):
-        # print xdate
-        if xdate.year == inyr:
-            try:
-                xdate = datetime((xdate.year + 1), inmo, indate)
-            except ValueError:
-                xdate = datetime((xdate.year + 1), inmo, indate - 1)
-            continue
-        for datechange in xrange(0, 35):
-            tdelta = timedelta(days=datechange)
-            analogdate = xdate + tdelta
-            # print analogdate,xdate
-            if analogdate.year > eyear:
-                continue
-            if analogdate.year == inyr:
-                continue
-            if analogdate.month != xdate.month:
-                continue
-            fnlist.append(analogdate)
-        try:
-            xdate = datetime((xdate.year + 1), inmo, indate)
-        except ValueError:
-            xdate = datetime(xdate.year + 1, inmo, indate - 1)
-
-    return fnlist
+
+def get_analog_days(forecast_date, window, byear, eyear, all_dates=False, month_range=True,):
+    """
+ Same as get_analog_dates, but returns the dates as a sorted datetime64[D] NumPy array.
+    """
+    if all_dates:
+        return _analog_days(forecast_date,0,byear,eyear,'all',min_gap=31)
+    return _analog_days(forecast_date,window,byear,eyear,'month' if month_range else 'day')
+
+
+def get_analog_idxs(forecast_date, train_dates, window, byear=None, eyear=None, all_dates=False, month_range=True,):
+    """
+ Index version of get_analog_dates: which training dates a forecast may use as analogs.
+
+inputs:
+ forecast_date - some datetime object (or datetime64) of the forecast date
+ train_dates - list of datetime objects (or datetime64 array) of the training archive's time axis
+ window/all_dates/month_range - see get_analog_dates
+ byear/eyear - see get_analog_dates, default to the first/last training year
+
+Returns:
+ idxs - sorted integer NumPy array of positions in train_dates, ready to pass to find_analogs
+    """
+    train_days = np.asarray(train_dates,dtype='datetime64[D]')
+    byear = int(_years(train_days.min())) if byear is None else byear
+    eyear = int(_years(train_days.max())) if eyear is None else eyear
+    allowed = get_analog_days(forecast_date,window,byear,eyear,all_dates=all_dates,month_range=month_range)
+    return np.flatnonzero(np.isin(train_days,allowed))
 
 
 def get_analog_dates(forecast_date, window, byear, eyear, all_dates=False, month_range=True,):
@@ -86,129 +155,11 @@ Optional arguments:
  month_range - If True, window will be n months before/after fcst month instead of n days before/after fcst date.
     Ignored if all_dates = True
 
+The candidate dates for each calendar day are built once with datetime64 arithmetic and cached, see
+get_analog_days/get_analog_idxs for array versions.
 
 Returns:
  outdates - List of dates meeting the criteria
     """
-
-    fnlist = []
-
-    # --- Here, since we are now using bias-corrected data, we can get additional potential analog dates!
-    if all_dates:
-        xdate = datetime(byear,1,1)
-
-        while xdate <= datetime(eyear,12,31):
-            if xdate.year != forecast_date.year: # --- cross validation
-                if np.abs((xdate-forecast_date).days) > 31: # --- more CV, don't want dates too close together
-
-                    fnlist.append(xdate)
-            xdate += timedelta(days=1)
-
-    else:
-        if month_range:
-            try:
-                xdate = datetime(byear,forecast_date.month,forecast_date.day)
-            except ValueError:
-                # --- For leap year issues
-                xdate = datetime(byear,forecast_date.month,forecast_date.day-1)
-
-            while xdate < datetime(eyear+1,1,1):
-                #print xdate
-                if xdate.year == forecast_date.year:
-                    try:
-                        xdate = datetime((xdate.year + 1),forecast_date.month,forecast_date.day)
-                    except ValueError:
-                        xdate = datetime((xdate.year + 1),forecast_date.month,forecast_date.day-1)
-                    continue
-                for datechange in reversed(xrange(0,100)):
-                    if xdate.month > 1:
-                        tdelta = timedelta(days=datechange)
-                        analogdate = xdate - tdelta
-                        if analogdate.year < byear:
-                            continue
-                        if analogdate.year == forecast_date.year:
-                            continue
-                        if analogdate < datetime(xdate.year,xdate.month-1,1):
-                            continue
-                        fnlist.append(analogdate)
-                    elif xdate.month == 1:
-                        tdelta = timedelta(days=datechange)
-                        analogdate = xdate - tdelta
-                        if analogdate.year < byear:
-                            continue
-                        if analogdate.year == forecast_date.year:
-                            continue
-                        if analogdate < datetime(xdate.year-1,12,1):
-                            continue
-                        fnlist.append(analogdate)
-                for datechange in xrange(1,101):
-                    if xdate.month < 12:
-                        tdelta = timedelta(days=datechange)
-                        analogdate = xdate + tdelta
-                        if analogdate.year > eyear:
-                            continue
-                        if analogdate.year == forecast_date.year:
-                            continue
-                        try:
-                            datetime(xdate.year,xdate.month+2,1)
-                        except ValueError: # --- xdate.month == 11
-                            if analogdate >= datetime(xdate.year+1,1,1):
-                                continue
-                        else:
-                            if analogdate >= datetime(xdate.year,xdate.month+2,1):
-                                continue
-                        fnlist.append(analogdate)
-                    elif xdate.month == 12:
-                        tdelta = timedelta(days=datechange)
-                        analogdate = xdate + tdelta
-                        if analogdate.year > eyear:
-                            continue
-                        if analogdate.year == forecast_date.year:
-                            continue
-                        if analogdate >= datetime(xdate.year+1,2,1):
-                            continue
-                        fnlist.append(analogdate)
-                try:
-                    xdate = datetime((xdate.year + 1),forecast_date.month,forecast_date.day)
-                except ValueError: # --- 2/29 on non-leap year issue
-                    xdate = datetime(xdate.year+1,forecast_date.month,forecast_date.day-1)
-
-        if not month_range:
-            try:
-                xdate = datetime(byear,forecast_date.month,forecast_date.date)
-            except ValueError:
-                # --- For leap year issues
-                xdate = datetime(byear,forecast_date.month,forecast_date.date-1)
-
-            while xdate < datetime(eyear+1,1,1):
-                #print xdate
-                if xdate.year == forecast_date.year:
-                    try:
-                        xdate = datetime((xdate.year + 1),forecast_date.month,forecast_date.date)
-                    except ValueError: # --- 2/29 on non-leap year issue
-                        xdate = datetime((xdate.year + 1),forecast_date.month,forecast_date.date-1)
-                    continue
-                for datechange in reversed(xrange(0,window+1)):
-                    tdelta = timedelta(days=datechange)
-                    analogdate = xdate - tdelta
-                    if analogdate.year < byear:
-                        continue
-                    if analogdate.year == forecast_date.year:
-                        continue
-                    fnlist.append(analogdate)
-
-                for datechange in xrange(1,window):
-                    tdelta = timedelta(days=datechange)
-                    analogdate = xdate + tdelta
-                    if analogdate.year > eyear:
-                        continue
-                    if analogdate.year == forecast_date.year:
-                        continue
-                    fnlist.append(analogdate)
-
-                try:
-                    xdate = datetime((xdate.year + 1),forecast_date.month,forecast_date.date)
-                except ValueError: # --- 2/29 on non-leap year issue
-                    xdate = datetime(xdate.year+1,forecast_date.month,forecast_date.date-1)
-
-    return fnlist
\ No newline at end of file
+    return _as_datetimes(get_analog_days(forecast_date,window,byear,eyear,all_dates=all_dates,
+                                         month_range=month_range))
@@ -1,11 +1,9 @@
-from distutils.core import setup
-from setuptools import find_packages
+from setuptools import setup, find_packages
 
 
 required = [
-    "numba>=0.15",
-    "numpy>=1.9",
-    "scipy>=0.14"
+    "numpy>=1.16",
+    "scipy>=1.5"
 ]
 
 
@@ -20,6 +18,8 @@ setup(
     keywords = "meteorology atmospheric sciences weather analogs",
     url = "https://github.com/mogismog/pyanalog",
     packages=find_packages(),
+    python_requires=">=3.9",
+    install_requires=required,
     long_description='Stuff goes here later...',
     classifiers=[
         "Development Status :: 3 - Alpha",